@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+# Times VM provisioning and the resource report against the fake API server,
+# counting the API calls each phase makes and the peak memory it allocates.
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from fake_server import CLUSTER_NAME, IMAGES, RESOURCE_CLASSES, pcidevice_address, run  # noqa: E402
+from modules.harvester import Harvester  # noqa: E402
+from modules.state import State  # noqa: E402
+from modules import profiler  # noqa: E402
+
+import requests  # noqa: E402
+import urllib3  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+def get_config(port, pcidevices):
+    return {
+        "rancher": {"hostname": f"127.0.0.1:{port}", "cluster_name": "local"},
+        "api_token": "token-fake:secret",
+        "resource_definitions": {name: [resource] for name, resource in RESOURCE_CLASSES.items()},
+        "kubernetes": {"rke2_provisioned_install": True, "install_harvester_csi": True},
+        "network": {
+            "name": "harvester-public/vlan-1000",
+            "gateway": "192.168.0.1",
+            "netmask": "255.255.0.0",
+            "dns_servers": ["192.168.0.1"],
+            "vlan_id": 1000,
+            "clusternetwork": "mgmt",
+            "bridge_interface": "mgmt-br",
+            "ip_pool": {"start": "192.168.100.10", "end": "192.168.100.20"},
+        },
+        "machines": {
+            "ssh_user": "rancher",
+            "pcidevices": {
+                f"device_{i}": {"address": [pcidevice_address(i)]} for i in range(pcidevices)
+            },
+        },
+    }
+
+
+def get_blueprint(vms, nodes, pcidevices):
+    images = list(IMAGES)
+    machines = []
+    for i in range(vms):
+        vm = {
+            "name": f"bench-vm-{i:05d}",
+            "ip": f"192.168.{i // 250}.{i % 250 + 2}",
+            "role": ["worker"],
+            "cpu": 2,
+            "memory": 8,
+            "reserved_memory": 1,
+            "disk_size": 50,
+        }
+        if pcidevices > 0 and i % 8 == 0:
+            # pinned vm with a passthrough device
+            vm["type"] = "gpu"
+            vm["harvester_node"] = f"node-{i % nodes:03d}"
+            vm["pcidevices"] = [f"device_{(i // 8) % pcidevices}"]
+        if i % 5 == 0:
+            vm["extra_disks"] = [{"storageclass": "harvester-longhorn", "disk_size": 25}]
+        machines.append(vm)
+    return {
+        "cluster": {"name": "bench"},
+        "harvester": {"cluster_name": CLUSTER_NAME},
+        "machines": {
+            "namespace": "bench",
+            "template_image_name": images[0],
+            "template_image_name_gpu": images[1],
+            "vms": machines,
+        },
+    }
+
+
+class FakeServer:
+    def __init__(self, nodes, vmis, pcidevices, cluster_delay=0):
+        ready = multiprocessing.Queue()
+        # separate process, so the server does not count towards the measured time and memory
+        self.process = multiprocessing.Process(
+            target=run, args=(nodes, vmis, pcidevices, 0, ready, cluster_delay), daemon=True
+        )
+        self.process.start()
+        self.port = ready.get(timeout=60)
+        self.session = requests.Session()
+
+    def reset(self):
+        self.session.get(f"https://127.0.0.1:{self.port}/_reset", verify=False)
+
+    def get_calls(self):
+        return self.session.get(f"https://127.0.0.1:{self.port}/_stats", verify=False).json()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def measure(server, name, function, repeat=1):
+    # best of several runs, the first run also pays for lazy imports of the client models
+    best = None
+    for _ in range(repeat):
+        server.reset()
+        tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function()
+        wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        calls = server.get_calls()
+        if best is None or wall < best["seconds"]:
+            best = {
+                "phase": name,
+                "seconds": round(wall, 4),
+                "api_calls": sum(calls.values()),
+                "peak_mb": round(peak / 1024 / 1024, 2),
+                "calls": calls,
+            }
+    return result, best
+
+
+def print_results(results, verbose):
+    print(f"{'PHASE':<28} {'SECONDS':>10} {'API CALLS':>10} {'PEAK MB':>10}")
+    for result in results:
+        print(
+            f"{result['phase']:<28} {result['seconds']:>10.3f} "
+            f"{result['api_calls']:>10} {result['peak_mb']:>10.2f}"
+        )
+        if verbose:
+            for call, count in sorted(result["calls"].items()):
+                print(f"  {call:<54} {count:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark VM provisioning and the resource report against a fake Harvester"
+    )
+    parser.add_argument("--nodes", help="number of Harvester nodes", type=int, default=10)
+    parser.add_argument("--vmis", help="number of running VMs in the cluster", type=int, default=200)
+    parser.add_argument("--pcidevices", help="number of PCI devices", type=int, default=40)
+    parser.add_argument("--vms", help="number of VMs in the blueprint", type=int, default=50)
+    parser.add_argument(
+        "--parallel", help="number of provisioning steps run concurrently", type=int, default=1
+    )
+    parser.add_argument("--async-client", help="use the asyncio Kubernetes client", action="store_true")
+    parser.add_argument(
+        "--cluster-delay",
+        help="seconds until a new downstream cluster is ready",
+        type=float,
+        default=5,
+    )
+    parser.add_argument(
+        "--repeat", help="runs of the repeatable phases, the best is reported", type=int, default=3
+    )
+    parser.add_argument(
+        "--profile", help="profile the API calls and write a chrome trace to this file", default=""
+    )
+    parser.add_argument("--json", help="write the results to this file", default="")
+    parser.add_argument("--verbose", "-v", help="show API calls per endpoint", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    urllib3.disable_warnings()
+    # templates are loaded relative to the repository
+    os.chdir(REPO_DIR)
+
+    if args.profile != "":
+        profiler.enable()
+
+    server = FakeServer(args.nodes, args.vmis, args.pcidevices, args.cluster_delay)
+    try:
+        config = get_config(server.port, args.pcidevices)
+        blueprint = get_blueprint(args.vms, args.nodes, args.pcidevices)
+        blueprint["harvester"]["async_client"] = args.async_client
+
+        results = []
+        harvester, result = measure(server, "harvester init", lambda: Harvester(config, blueprint))
+        results.append(result)
+        _, result = measure(server, "resources", harvester.get_resources, args.repeat)
+        results.append(result)
+        provision_args = argparse.Namespace(
+            updatevm=False, vms="", parallel=args.parallel, plan=False
+        )
+        _, result = measure(
+            server,
+            "provision with cluster",
+            lambda: harvester.provision(provision_args, update_cluster=True),
+        )
+        results.append(result)
+        _, result = measure(
+            server,
+            "update vms (unchanged)",
+            lambda: harvester.create_vms(updatevm=True, parallelism=args.parallel),
+            args.repeat,
+        )
+        results.append(result)
+
+        with tempfile.TemporaryDirectory() as directory:
+            # the first run with a state renders everything and records the fingerprints
+            harvester.state = State(directory, "bench")
+            with contextlib.redirect_stdout(io.StringIO()):
+                harvester.create_vms(updatevm=True, parallelism=args.parallel)
+            _, result = measure(
+                server,
+                "update vms (state)",
+                lambda: harvester.create_vms(updatevm=True, parallelism=args.parallel),
+                args.repeat,
+            )
+            results.append(result)
+
+            def update_one_vm():
+                blueprint["machines"]["vms"][0]["cpu"] += 1
+                return harvester.create_vms(updatevm=True, parallelism=args.parallel)
+
+            _, result = measure(server, "update one vm (state)", update_one_vm, args.repeat)
+            results.append(result)
+
+        # offline rendering from a snapshot makes no api calls at all
+        offline = Harvester(config, blueprint, snapshot=harvester.get_snapshot())
+        with tempfile.TemporaryDirectory() as directory:
+            _, result = measure(
+                server,
+                "render (snapshot)",
+                lambda: offline.render(directory, args.parallel),
+                args.repeat,
+            )
+            results.append(result)
+
+        # a cluster that never becomes ready fails the cluster step after the timeout,
+        # the node command and every vm step that needs it are skipped
+        unready_config = dict(config, rancher=dict(config["rancher"], cluster_timeout=2))
+        unready_blueprint = dict(blueprint, cluster={"name": "bench-unready"})
+        unready = Harvester(unready_config, unready_blueprint)
+        graph = unready.get_provision_graph(provision_args, update_cluster=True)
+        _, result = measure(
+            server, "provision, cluster not ready", lambda: graph.run(args.parallel)
+        )
+        results.append(result)
+        # one step per vm, or a single vms step with the async client
+        vm_steps = [name for name in graph.steps if name.startswith("vm ") or name == "vms"]
+        skipped_vms = len([name for name in vm_steps if name in graph.skipped])
+        rancher_counters = harvester.rancher.get_api_counters()
+        unready.close()
+        harvester.close()
+    finally:
+        server.stop()
+
+    print_results(results, args.verbose)
+    print(f"Cluster not ready: {skipped_vms} of {len(vm_steps)} VM steps skipped")
+    print(
+        f"Rancher API: {rancher_counters['requests']} requests, "
+        f"{rancher_counters['retries']} retries, {rancher_counters['errors']} errors"
+    )
+    if args.profile != "":
+        profiler.report(args.profile)
+    if args.json != "":
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "arguments": vars(args),
+                    "results": results,
+                    "rancher": rancher_counters,
+                    "cluster_not_ready": {"vm_steps": len(vm_steps), "skipped": skipped_vms},
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,596 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the Rancher v3 API and the Kubernetes, KubeVirt and Harvester
+# APIs used by modules/kubernetes.Kubernetes, serving a synthetic Harvester cluster.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import argparse
+import collections
+import json
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# group, version, plural, kind, namespaced
+RESOURCES = [
+    ("", "v1", "nodes", "Node", False),
+    ("", "v1", "pods", "Pod", True),
+    ("", "v1", "namespaces", "Namespace", False),
+    ("", "v1", "secrets", "Secret", True),
+    ("", "v1", "configmaps", "ConfigMap", True),
+    ("", "v1", "serviceaccounts", "ServiceAccount", True),
+    ("rbac.authorization.k8s.io", "v1", "rolebindings", "RoleBinding", True),
+    ("kubevirt.io", "v1", "virtualmachines", "VirtualMachine", True),
+    ("kubevirt.io", "v1", "virtualmachineinstances", "VirtualMachineInstance", True),
+    ("harvesterhci.io", "v1beta1", "virtualmachineimages", "VirtualMachineImage", True),
+    ("devices.harvesterhci.io", "v1beta1", "pcidevices", "PCIDevice", False),
+    ("devices.harvesterhci.io", "v1beta1", "pcideviceclaims", "PCIDeviceClaim", False),
+    ("k8s.cni.cncf.io", "v1", "network-attachment-definitions", "NetworkAttachmentDefinition", True),
+    ("loadbalancer.harvesterhci.io", "v1beta1", "ippools", "IPPool", False),
+    ("provisioning.cattle.io", "v1", "clusters", "Cluster", True),
+]
+
+RESOURCE_CLASSES = {
+    "gpu": "nvidia.com/AD106_GEFORCE_RTX_4060_TI",
+    "nvme": "kingston.com/NV3_NVME_SSD_E27T_DRAMLESS",
+}
+
+IMAGES = {
+    "sles15-sp7.x86_64-15.7.0.qcow2": "image-sles",
+    "sles15-sp7-nvidia.x86_64-15.7.0.qcow2": "image-sles-nvidia",
+}
+
+CLUSTER_NAME = "harvester"
+CLUSTER_ID = "c-fake1"
+
+
+def get_resource(group, version, plural):
+    for resource in RESOURCES:
+        if resource[0] == group and resource[1] == version and resource[2] == plural:
+            return resource
+    return None
+
+
+def status(code, reason, message):
+    return {
+        "kind": "Status",
+        "apiVersion": "v1",
+        "metadata": {},
+        "status": "Failure",
+        "reason": reason,
+        "message": message,
+        "code": code,
+    }
+
+
+def pcidevice_address(index):
+    return f"0000:{index // 8:02x}:00.{index % 8}"
+
+
+def generate(nodes, vmis, pcidevices, pods_per_node=20):
+    # synthetic cluster: nodes, their pods, vmis spread over the nodes,
+    # pci devices (all enabled for passthrough) and the vm images
+    store = {resource[2]: {} for resource in RESOURCES}
+
+    def add(plural, obj):
+        metadata = obj["metadata"]
+        store[plural][(metadata.get("namespace"), metadata["name"])] = obj
+
+    node_names = [f"node-{i:03d}" for i in range(nodes)]
+    for name in node_names:
+        add(
+            "nodes",
+            {
+                "apiVersion": "v1",
+                "kind": "Node",
+                "metadata": {"name": name, "labels": {"kubernetes.io/hostname": name}},
+                "status": {
+                    "capacity": {"cpu": "64", "memory": "263921180Ki", "pods": "200"},
+                    "allocatable": {"cpu": "62", "memory": "251338268Ki", "pods": "200"},
+                },
+            },
+        )
+        for i in range(pods_per_node):
+            add(
+                "pods",
+                {
+                    "apiVersion": "v1",
+                    "kind": "Pod",
+                    "metadata": {"name": f"{name}-pod-{i}", "namespace": "kube-system"},
+                    "spec": {"nodeName": name, "containers": [{"name": "c", "image": "busybox"}]},
+                },
+            )
+
+    free_devices = collections.defaultdict(list)
+    classes = list(RESOURCE_CLASSES.values())
+    for i in range(pcidevices):
+        node = node_names[i % nodes]
+        index = i // nodes
+        name = f"{node}-{pcidevice_address(index).replace(':', '').replace('.', '')}"
+        resource_name = classes[i % len(classes)]
+        add(
+            "pcidevices",
+            {
+                "apiVersion": "devices.harvesterhci.io/v1beta1",
+                "kind": "PCIDevice",
+                "metadata": {"name": name, "labels": {"nodename": node}},
+                "status": {
+                    "address": pcidevice_address(index),
+                    "resourceName": resource_name,
+                    "nodeName": node,
+                },
+            },
+        )
+        add(
+            "pcideviceclaims",
+            {
+                "apiVersion": "devices.harvesterhci.io/v1beta1",
+                "kind": "PCIDeviceClaim",
+                "metadata": {"name": name},
+                "spec": {"nodeName": node, "address": pcidevice_address(index)},
+            },
+        )
+        free_devices[node].append({"name": name, "deviceName": resource_name})
+
+    for i in range(vmis):
+        node = node_names[i % nodes]
+        name = f"vmi-{i:05d}"
+        devices = {}
+        if i % 4 == 0 and free_devices[node]:
+            devices["hostDevices"] = [free_devices[node].pop()]
+        add(
+            "virtualmachineinstances",
+            {
+                "apiVersion": "kubevirt.io/v1",
+                "kind": "VirtualMachineInstance",
+                "metadata": {
+                    "name": name,
+                    "namespace": "default",
+                    "labels": {"kubevirt.io/nodeName": node},
+                },
+                "spec": {
+                    "domain": {
+                        "cpu": {"cores": 2},
+                        "memory": {"guest": "7Gi"},
+                        "devices": devices,
+                    }
+                },
+            },
+        )
+        add(
+            "pods",
+            {
+                "apiVersion": "v1",
+                "kind": "Pod",
+                "metadata": {"name": f"virt-launcher-{name}", "namespace": "default"},
+                "spec": {"nodeName": node, "containers": [{"name": "compute", "image": "virt-launcher"}]},
+            },
+        )
+
+    for display_name, name in IMAGES.items():
+        add(
+            "virtualmachineimages",
+            {
+                "apiVersion": "harvesterhci.io/v1beta1",
+                "kind": "VirtualMachineImage",
+                "metadata": {
+                    "name": name,
+                    "namespace": "default",
+                    "labels": {"harvesterhci.io/imageDisplayName": display_name},
+                },
+                "spec": {"displayName": display_name},
+                "status": {"progress": 100, "storageClassName": f"longhorn-{name}"},
+            },
+        )
+    add(
+        "configmaps",
+        {
+            "apiVersion": "v1",
+            "kind": "ConfigMap",
+            "metadata": {"name": "vip", "namespace": "harvester-system"},
+            "data": {"ip": "127.0.0.1"},
+        },
+    )
+    return store
+
+
+def match_labels(obj, label_selector):
+    labels = obj["metadata"].get("labels") or {}
+    for requirement in label_selector.split(","):
+        if requirement == "":
+            continue
+        key, _, value = requirement.partition("=")
+        if labels.get(key) != value:
+            return False
+    return True
+
+
+def match_fields(obj, field_selector):
+    for requirement in field_selector.split(","):
+        if requirement == "":
+            continue
+        key, _, value = requirement.partition("=")
+        current = obj
+        for part in key.split("."):
+            current = (current or {}).get(part)
+        if current != value:
+            return False
+    return True
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store, cluster_delay=0):
+        super().__init__(address, FakeApiRequestHandler)
+        self.store = store
+        # seconds until a created downstream cluster reports Ready
+        self.cluster_delay = cluster_delay
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+
+    def count(self, key):
+        with self.lock:
+            self.calls[key] += 1
+
+
+class FakeApiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length == 0:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def parse(self):
+        url = urlparse(self.path)
+        path = "/" + url.path.lstrip("/")
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        return path, query
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def handle_request(self, method):
+        path, query = self.parse()
+        body = self.read_body()
+        if path == "/_stats":
+            with self.server.lock:
+                return self.send_json(200, dict(self.server.calls))
+        if path == "/_reset":
+            with self.server.lock:
+                self.server.calls.clear()
+            return self.send_json(200, {})
+        if path.startswith("/v3/"):
+            return self.rancher(method, path, query)
+        return self.kubernetes(method, path, query, body)
+
+    # rancher v3
+
+    def rancher(self, method, path, query):
+        parts = path.strip("/").split("/")
+        self.server.count(f"rancher {method} /{'/'.join(parts[:2])}")
+        if parts[:2] == ["v3", "clusters"] and len(parts) == 2:
+            clusters = [
+                {"id": "local", "name": "local", "labels": {}},
+                {
+                    "id": CLUSTER_ID,
+                    "name": CLUSTER_NAME,
+                    "labels": {"provider.cattle.io": "harvester"},
+                },
+            ]
+            if "name" in query:
+                # downstream clusters of a blueprint exist under any name
+                clusters = [c for c in clusters if c["name"] == query["name"]] or [
+                    {"id": f"c-{query['name']}", "name": query["name"], "labels": {}}
+                ]
+            return self.send_json(200, {"data": clusters})
+        if parts[:2] == ["v3", "clusters"] and query.get("action") == "generateKubeconfig":
+            return self.send_json(200, {"config": self.kubeconfig()})
+        if parts[:2] == ["v3", "clusters"] and parts[-1] == "clusterregistrationtokens":
+            return self.send_json(
+                200, {"data": [{"nodeCommand": "curl -fL https://rancher/system-agent-install.sh | sh -s -"}]}
+            )
+        if parts[:2] == ["v3", "tokens"]:
+            return self.send_json(200, {"name": parts[2], "expired": False, "expiresAt": ""})
+        return self.send_json(404, status(404, "NotFound", path))
+
+    def kubeconfig(self):
+        host, port = self.server.server_address[:2]
+        return json.dumps(
+            {
+                "apiVersion": "v1",
+                "kind": "Config",
+                "clusters": [
+                    {
+                        "name": CLUSTER_NAME,
+                        "cluster": {
+                            "server": f"https://{host}:{port}",
+                            "insecure-skip-tls-verify": True,
+                        },
+                    }
+                ],
+                "contexts": [
+                    {"name": CLUSTER_NAME, "context": {"cluster": CLUSTER_NAME, "user": CLUSTER_NAME}}
+                ],
+                "current-context": CLUSTER_NAME,
+                "users": [{"name": CLUSTER_NAME, "user": {"token": "kubeconfig-user-fake:secret"}}],
+            }
+        )
+
+    # kubernetes
+
+    def discovery(self, path):
+        if path == "/version":
+            return {"major": "1", "minor": "31", "gitVersion": "v1.31.0+rke2r1"}
+        if path == "/api":
+            return {"kind": "APIVersions", "versions": ["v1"]}
+        if path == "/apis":
+            groups = {}
+            for group, version, *_ in RESOURCES:
+                if group != "":
+                    groups.setdefault(group, set()).add(version)
+            return {
+                "kind": "APIGroupList",
+                "apiVersion": "v1",
+                "groups": [
+                    {
+                        "name": group,
+                        "versions": [
+                            {"groupVersion": f"{group}/{version}", "version": version}
+                            for version in sorted(versions)
+                        ],
+                        "preferredVersion": {
+                            "groupVersion": f"{group}/{sorted(versions)[0]}",
+                            "version": sorted(versions)[0],
+                        },
+                    }
+                    for group, versions in groups.items()
+                ],
+            }
+        parts = path.strip("/").split("/")
+        if parts[0] == "api" and len(parts) == 2:
+            group, version = "", parts[1]
+        elif parts[0] == "apis" and len(parts) == 3:
+            group, version = parts[1], parts[2]
+        else:
+            return None
+        return {
+            "kind": "APIResourceList",
+            "apiVersion": "v1",
+            "groupVersion": f"{group}/{version}".strip("/"),
+            "resources": [
+                {
+                    "name": plural,
+                    "singularName": kind.lower(),
+                    "namespaced": namespaced,
+                    "kind": kind,
+                    "verbs": ["create", "delete", "get", "list", "patch", "update", "watch"],
+                }
+                for g, v, plural, kind, namespaced in RESOURCES
+                if g == group and v == version
+            ],
+        }
+
+    def kubernetes(self, method, path, query, body):
+        document = self.discovery(path) if method == "GET" else None
+        if document is not None:
+            self.server.count("kubernetes GET discovery")
+            return self.send_json(200, document)
+
+        parts = path.strip("/").split("/")
+        if parts[0] == "api":
+            group, version, rest = "", parts[1], parts[2:]
+        else:
+            group, version, rest = parts[1], parts[2], parts[3:]
+        namespace = None
+        if len(rest) >= 3 and rest[0] == "namespaces":
+            namespace, rest = rest[1], rest[2:]
+        resource = get_resource(group, version, rest[0])
+        if resource is None:
+            self.server.count(f"kubernetes {method} unknown")
+            return self.send_json(404, status(404, "NotFound", path))
+        plural = resource[2]
+        name = rest[1] if len(rest) > 1 else None
+        verb = {"GET": "get" if name else "list", "POST": "create", "PATCH": "apply", "PUT": "update"}[method]
+        self.server.count(f"kubernetes {verb} {plural}")
+        objects = self.server.store[plural]
+
+        if verb == "list" and query.get("watch", "").lower() in ["true", "1"]:
+            return self.watch(plural, objects, namespace, query)
+        if verb == "list":
+            return self.list(resource, objects, namespace, query)
+        key = (namespace, name)
+        if verb == "get":
+            with self.server.lock:
+                obj = objects.get(key)
+            if obj is None:
+                return self.send_json(404, status(404, "NotFound", f"{plural} {name} not found"))
+            return self.send_json(200, obj)
+        if verb == "create":
+            name = body["metadata"]["name"]
+            key = (namespace, name)
+            body["metadata"]["uid"] = f"uid-{plural}-{namespace}-{name}"
+            if body.get("type") == "kubernetes.io/service-account-token":
+                # filled in by the token controller in a real cluster
+                body["data"] = {"token": "ZmFrZS10b2tlbg==", "ca.crt": "ZmFrZS1jYQ=="}
+            with self.server.lock:
+                if key in objects:
+                    return self.send_json(
+                        409, status(409, "AlreadyExists", f"{plural} {name} already exists")
+                    )
+                objects[key] = body
+            return self.send_json(201, body)
+        with self.server.lock:
+            if namespace is not None:
+                body["metadata"]["namespace"] = namespace
+            objects[key] = body
+        return self.send_json(200, body)
+
+    def watch(self, plural, objects, namespace, query):
+        # one ADDED event per object; clusters are Ready once the provisioning delay has
+        # passed and clusters named *-unready never become Ready
+        if plural == "clusters":
+            time.sleep(self.server.cluster_delay)
+        with self.server.lock:
+            items = [
+                obj
+                for (obj_namespace, _), obj in objects.items()
+                if namespace is None or obj_namespace == namespace
+            ]
+        lines = []
+        for obj in items:
+            if not match_fields(obj, query.get("fieldSelector", "")):
+                continue
+            if plural != "clusters":
+                lines.append(json.dumps({"type": "ADDED", "object": obj}) + "\n")
+                continue
+            obj = dict(obj)
+            if obj["metadata"]["name"].endswith("-unready"):
+                # the client watches again until its timeout, don't let it spin
+                time.sleep(0.5)
+                condition = {"type": "Ready", "status": "False", "reason": "Provisioning"}
+            else:
+                condition = {"type": "Ready", "status": "True"}
+            obj["status"] = {"conditions": [condition]}
+            lines.append(json.dumps({"type": "ADDED", "object": obj}) + "\n")
+        data = "".join(lines).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def list(self, resource, objects, namespace, query):
+        group, version, plural, kind, namespaced = resource
+        with self.server.lock:
+            items = [
+                obj
+                for (obj_namespace, _), obj in objects.items()
+                if namespace is None or obj_namespace == namespace
+            ]
+        items = [
+            obj
+            for obj in items
+            if match_labels(obj, query.get("labelSelector", ""))
+            and match_fields(obj, query.get("fieldSelector", ""))
+        ]
+        start = int(query.get("continue", 0) or 0)
+        limit = int(query.get("limit", 0) or 0)
+        _continue = ""
+        if limit:
+            if start + limit < len(items):
+                _continue = str(start + limit)
+            items = items[start : start + limit]
+        metadata = {"resourceVersion": "1", "continue": _continue}
+        accept = self.headers.get("Accept", "")
+        if "as=Table" in accept:
+            return self.send_json(
+                200,
+                {
+                    "kind": "Table",
+                    "apiVersion": "meta.k8s.io/v1",
+                    "metadata": metadata,
+                    "columnDefinitions": [
+                        {"name": "Name", "type": "string"},
+                        {"name": "Node", "type": "string"},
+                    ],
+                    "rows": [
+                        {"cells": [obj["metadata"]["name"], obj.get("spec", {}).get("nodeName", "<none>")]}
+                        for obj in items
+                    ],
+                },
+            )
+        if "as=PartialObjectMetadataList" in accept:
+            return self.send_json(
+                200,
+                {
+                    "kind": "PartialObjectMetadataList",
+                    "apiVersion": "meta.k8s.io/v1",
+                    "metadata": metadata,
+                    "items": [{"metadata": obj["metadata"]} for obj in items],
+                },
+            )
+        api_version = f"{group}/{version}".strip("/")
+        return self.send_json(
+            200,
+            {"kind": f"{kind}List", "apiVersion": api_version, "metadata": metadata, "items": items},
+        )
+
+
+def create_certificate(directory):
+    certificate = os.path.join(directory, "server.crt")
+    key = os.path.join(directory, "server.key")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+            "-subj", "/CN=127.0.0.1", "-keyout", key, "-out", certificate,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return certificate, key
+
+
+def create_server(store, address="127.0.0.1", port=0, cluster_delay=0):
+    server = FakeApiServer((address, port), store, cluster_delay)
+    directory = tempfile.mkdtemp(prefix="fake-harvester-")
+    certificate, key = create_certificate(directory)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certificate, key)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    return server
+
+
+def run(nodes, vmis, pcidevices, port=0, ready=None, cluster_delay=0):
+    server = create_server(
+        generate(nodes, vmis, pcidevices), port=port, cluster_delay=cluster_delay
+    )
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Rancher and Harvester API server")
+    parser.add_argument("--nodes", type=int, default=10)
+    parser.add_argument("--vmis", type=int, default=200)
+    parser.add_argument("--pcidevices", type=int, default=40)
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--cluster-delay", type=float, default=0)
+    args = parser.parse_args()
+    print(f"Serving on https://127.0.0.1:{args.port}")
+    run(args.nodes, args.vmis, args.pcidevices, args.port, cluster_delay=args.cluster_delay)
+
+
+if __name__ == "__main__":
+    main()
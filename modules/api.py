@@ -1,27 +1,96 @@
 import requests
+import threading
 import logging
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .profiler import measure
 
 requests.packages.urllib3.disable_warnings()
 logger = logging.getLogger(__name__)
 
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
 
 class Api:
-    def __init__(self, rancher_host, token, tls_verify=False):
+    def __init__(
+        self,
+        rancher_host,
+        token,
+        tls_verify=False,
+        timeout=30,
+        retries=3,
+        backoff_factor=0.5,
+        pool_maxsize=10,
+    ):
         self.rancher_host = rancher_host
         self.tls_verify = tls_verify
+        self.timeout = timeout
         self.headers = {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json",
         }
+        # one keep-alive session for all calls, retried with exponential backoff on 429/5xx;
+        # only GET is retried, a retried generateKubeconfig POST would mint another token
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            max_retries=retry, pool_connections=1, pool_maxsize=pool_maxsize
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.headers.update(self.headers)
+        self.counters_lock = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "errors": 0}
+
+    def count(self, result):
+        retries = 0
+        if result.raw is not None and result.raw.retries is not None:
+            retries = len(result.raw.retries.history)
+        with self.counters_lock:
+            self.counters["requests"] += 1
+            self.counters["retries"] += retries
+            if result.status_code >= 400:
+                self.counters["errors"] += 1
+        if result.status_code >= 400:
+            logger.warning(f"{result.request.method} {result.url} returned {result.status_code}")
+
+    def get_counters(self):
+        with self.counters_lock:
+            return dict(self.counters)
 
     def get(self, path):
         url = f"https://{self.rancher_host}/{path}"
-        result = requests.get(url=url, headers=self.headers, verify=self.tls_verify)
+        with measure("rancher", f"GET {path.split('?')[0]}") as event:
+            # verify per call, a CA bundle from the environment overrides the session setting
+            result = self.session.get(url=url, verify=self.tls_verify, timeout=self.timeout)
+            if event is not None:
+                event.size += len(result.content)
+                event.requests += 1
+        self.count(result)
         return result.json()
 
     def post(self, path, data=None):
         url = f"https://{self.rancher_host}/{path}"
-        result = requests.post(
-            url=url, data=data, headers=self.headers, verify=self.tls_verify
-        )
+        with measure("rancher", f"POST {path.split('?')[0]}") as event:
+            result = self.session.post(
+                url=url, data=data, verify=self.tls_verify, timeout=self.timeout
+            )
+            if event is not None:
+                event.size += len(data or "") + len(result.content)
+                event.requests += 1
+        self.count(result)
         return result.json()
+
+    def close(self):
+        counters = self.get_counters()
+        logger.info(
+            f"Rancher API: {counters['requests']} requests, {counters['retries']} retries, "
+            f"{counters['errors']} errors"
+        )
+        self.session.close()
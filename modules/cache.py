@@ -0,0 +1,64 @@
+import json
+import os
+import hashlib
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# key/value cache with expiry, kept in memory for the whole process and optionally on disk
+class Cache:
+    memory = {}
+    memory_lock = threading.Lock()
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        if self.directory:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+
+    def get_filename(self, key):
+        return os.path.join(
+            self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json"
+        )
+
+    def get(self, key):
+        with self.memory_lock:
+            entry = self.memory.get(key)
+        if entry is None and self.directory:
+            try:
+                with open(self.get_filename(key)) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                entry = None
+            if entry is not None:
+                with self.memory_lock:
+                    self.memory[key] = entry
+        if entry is None:
+            return None
+        if entry["expires"] <= time.time():
+            logger.debug(f"Cache entry {key} expired")
+            self.invalidate(key)
+            return None
+        return entry["value"]
+
+    def set(self, key, value, ttl):
+        entry = {"value": value, "expires": time.time() + ttl}
+        with self.memory_lock:
+            self.memory[key] = entry
+        if self.directory:
+            # entries can hold credentials, only readable by the owner
+            filename = self.get_filename(key)
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+
+    def invalidate(self, key):
+        with self.memory_lock:
+            self.memory.pop(key, None)
+        if self.directory:
+            try:
+                os.remove(self.get_filename(key))
+            except OSError:
+                pass
@@ -0,0 +1,180 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .profiler import phase
+
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StepError(Exception):
+    pass
+
+
+class Step:
+    __slots__ = ["name", "function", "requires", "after", "phase", "background", "index"]
+
+    def __init__(self, name, function, requires, after, phase, background, index):
+        self.name = name
+        self.function = function
+        self.requires = requires
+        self.after = after
+        self.phase = phase
+        self.background = background
+        self.index = index
+
+
+# provisioning steps with their dependencies, run concurrently as soon as all required
+# steps succeeded; steps can only require steps added before them, so there are no cycles
+class StepGraph:
+    def __init__(self):
+        self.steps = {}
+        self.results = {}
+        self.errors = {}
+        self.skipped = set()
+        self.durations = {}
+
+    # background steps mostly wait (for rancher to provision a cluster) and run
+    # next to the worker limit instead of taking a worker for their whole duration;
+    # a step runs after the steps in after have finished, failed or been skipped,
+    # but only when all steps in requires succeeded
+    def add(self, name, function, requires=None, phase=None, background=False, after=None):
+        requires = [r for r in (requires or []) if r is not None]
+        after = [a for a in (after or []) if a is not None and a not in requires]
+        for required in requires + after:
+            if required not in self.steps:
+                raise ValueError(f"Step {name} requires unknown step {required}")
+        if name in self.steps:
+            raise ValueError(f"Step {name} already exists")
+        self.steps[name] = Step(
+            name, function, requires, after, phase, background, len(self.steps)
+        )
+        return name
+
+    def get_dependents(self, after=False):
+        dependents = {name: [] for name in self.steps}
+        for step in self.steps.values():
+            for required in step.after if after else step.requires:
+                dependents[required].append(step.name)
+        return dependents
+
+    def get_stages(self):
+        # stage of a step is the length of its longest chain of requirements
+        stages = {}
+        for step in self.steps.values():
+            stages[step.name] = max(
+                (stages[r] + 1 for r in step.requires + step.after), default=0
+            )
+        return stages
+
+    def get_heights(self, durations=None):
+        # longest chain from a step to the end, in steps or in seconds
+        dependents = self.get_dependents()
+        followers = self.get_dependents(after=True)
+        heights = {}
+        for step in reversed(list(self.steps.values())):
+            weight = 1 if durations is None else durations.get(step.name, 0)
+            heights[step.name] = weight + max(
+                (heights[d] for d in dependents[step.name] + followers[step.name]),
+                default=0,
+            )
+        return heights
+
+    def format_plan(self):
+        stages = self.get_stages()
+        heights = self.get_heights()
+        lines = [f"{'STAGE': <7}{'STEP': <40}{'REQUIRES'}"]
+        for step in sorted(self.steps.values(), key=lambda s: (stages[s.name], s.index)):
+            name = f"{step.name} (background)" if step.background else step.name
+            requires = step.requires + [f"{a} (after)" for a in step.after]
+            lines.append(f"{stages[step.name]: <7}{name: <40}{', '.join(requires)}")
+        lines.append(
+            f"{len(self.steps)} steps in {max(stages.values(), default=-1) + 1} stages, "
+            f"critical path of {max(heights.values(), default=0)} steps"
+        )
+        return "\n".join(lines)
+
+    def run_step(self, step):
+        start = time.perf_counter()
+        try:
+            if step.phase is None:
+                return step.function()
+            with phase(step.phase):
+                return step.function()
+        finally:
+            self.durations[step.name] = time.perf_counter() - start
+
+    def skip(self, name, dependents, skipped=None):
+        # returns the newly skipped steps
+        if skipped is None:
+            skipped = []
+        if name in self.skipped:
+            return skipped
+        logger.warning(f"Step {name} skipped, a required step failed")
+        self.skipped.add(name)
+        skipped.append(name)
+        for dependent in dependents[name]:
+            self.skip(dependent, dependents, skipped)
+        return skipped
+
+    def run(self, workers=1):
+        workers = max(int(workers), 1)
+        dependents = self.get_dependents()
+        followers = self.get_dependents(after=True)
+        # ready steps on the longest chain go first, so the run approaches the critical path
+        heights = self.get_heights()
+        remaining = {
+            name: set(step.requires + step.after) for name, step in self.steps.items()
+        }
+        ready = [name for name, required in remaining.items() if not required]
+
+        def release(name, names):
+            for other in names:
+                if name not in remaining[other]:
+                    continue
+                remaining[other].discard(name)
+                if not remaining[other] and other not in self.skipped:
+                    ready.append(other)
+        running = {}
+        busy = 0
+        background = sum(1 for step in self.steps.values() if step.background)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers + background) as executor:
+            while ready or running:
+                ready.sort(key=lambda name: (-heights[name], self.steps[name].index))
+                for name in list(ready):
+                    step = self.steps[name]
+                    if not step.background:
+                        if busy >= workers:
+                            continue
+                        busy += 1
+                    ready.remove(name)
+                    running[executor.submit(self.run_step, step)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if not self.steps[name].background:
+                        busy -= 1
+                    try:
+                        self.results[name] = future.result()
+                    except Exception as e:
+                        logger.error(f"Step {name} failed: {e}")
+                        self.errors[name] = e
+                        skipped = []
+                        for dependent in dependents[name]:
+                            self.skip(dependent, dependents, skipped)
+                        # steps that only run after a failed or skipped step still run
+                        release(name, followers[name])
+                        for skipped_name in skipped:
+                            release(skipped_name, followers[skipped_name])
+                        continue
+                    release(name, dependents[name] + followers[name])
+        critical_path = max(self.get_heights(self.durations).values(), default=0)
+        logger.info(
+            f"Ran {len(self.results)} of {len(self.steps)} steps in "
+            f"{time.perf_counter() - start:.1f}s, critical path {critical_path:.1f}s"
+        )
+        return self.results
+
+    def succeeded(self, name):
+        return name in self.results
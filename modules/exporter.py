@@ -0,0 +1,78 @@
+from .inventory import InventoryRequestHandler
+
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ["available", "used", "free"]
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    return ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+
+
+# prometheus text format of the capacity report, refreshed from the inventory on an interval
+class Exporter(threading.Thread):
+    def __init__(self, inventory, cluster_name, interval=15):
+        super().__init__(name="exporter", daemon=True)
+        self.inventory = inventory
+        self.cluster_name = cluster_name
+        self.interval = interval
+        self.metrics = b""
+        self.stopped = threading.Event()
+
+    def render(self, data):
+        lines = []
+        for field in FIELDS:
+            name = f"harvester_node_resource_{field}"
+            lines.append(f"# HELP {name} {field.capitalize()} resources per Harvester node")
+            lines.append(f"# TYPE {name} gauge")
+            for node, node_data in sorted(data["nodes"].items()):
+                for resource, values in node_data["resources"].items():
+                    labels = format_labels(
+                        {"cluster": self.cluster_name, "node": node, "resource": resource}
+                    )
+                    lines.append(f"{name}{{{labels}}} {values[field]}")
+        for field in FIELDS:
+            name = f"harvester_cluster_resource_{field}"
+            lines.append(f"# HELP {name} {field.capitalize()} resources of the Harvester cluster")
+            lines.append(f"# TYPE {name} gauge")
+            for resource, values in data["totals"].items():
+                labels = format_labels({"cluster": self.cluster_name, "resource": resource})
+                lines.append(f"{name}{{{labels}}} {values[field]}")
+        name = "harvester_exporter_last_refresh_timestamp_seconds"
+        lines.append(f"# HELP {name} Time of the last refresh of the metrics")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name}{{{format_labels({'cluster': self.cluster_name})}}} {time.time():.3f}")
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def refresh(self):
+        if self.inventory.is_synced():
+            self.metrics = self.render(self.inventory.get())
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Unable to refresh metrics: {e}")
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class ExporterRequestHandler(InventoryRequestHandler):
+    exporter = None
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send(200, "text/plain; version=0.0.4", self.exporter.metrics)
+        else:
+            super().do_GET()
@@ -1,8 +1,15 @@
-from .kubernetes import Kubernetes
+from .kubernetes import Kubernetes, stamp_manifest_hash, get_manifest_hash
 from .rancher import Rancher
-from .utils import merge_dict, b64decode
-from .templates import Template
+from .utils import merge_dict, b64decode, print_vm_summary
+from .templates import Template, get_template_hash
 from .resources import Resources
+from .images import ImageCatalog
+from .pcidevices import PciInventory
+from .placement import Placement
+from .profiler import phase
+from .executor import StepGraph, StepError
+from .state import fingerprint
+from .render import render_vm_manifest, render_cloudinit_secret, render_vms, write_manifests
 
 import yaml
 from ipaddress import IPv4Network
@@ -13,64 +20,91 @@ logger = logging.getLogger(__name__)
 
 
 class Harvester:
-    def __init__(self, config, blueprint):
+    def __init__(self, config, blueprint, rancher=None, state=None, snapshot=None):
         self.config = merge_dict(config, blueprint)
-        self.rancher = Rancher(config)
-        self.kubernetes = Kubernetes(
-            self.rancher.get_kubeconfig(self.config["harvester"]["cluster_name"])
+        self.blueprint = blueprint
+        # fingerprints of the last run, None renders and checks every vm
+        self.state = state
+        self.config_fingerprint = None
+        self.rancher = rancher
+        # a rancher passed in is shared and closed by its owner
+        self.rancher_owned = rancher is None and snapshot is None
+        self.kubernetes = None
+        self.async_kubernetes = None
+        if snapshot is None:
+            if self.rancher is None:
+                self.rancher = Rancher(config)
+            cluster_name = self.config["harvester"]["cluster_name"]
+            kubeconfig = self.rancher.get_kubeconfig(cluster_name)
+
+            def unauthorized():
+                self.rancher.invalidate_kubeconfig(cluster_name)
+
+            self.kubernetes = Kubernetes(kubeconfig, unauthorized=unauthorized)
+            if self.config["harvester"].get("async_client", False):
+                # optional dependency, only needed when the async client is selected
+                from .kubernetes_async import AsyncKubernetes
+
+                self.async_kubernetes = AsyncKubernetes(kubeconfig, unauthorized=unauthorized)
+        # loaded by load_pci_inventory, as a provisioning step or before a resource report
+        self.pci_inventory = PciInventory(self.kubernetes)
+        self.resources = Resources(
+            self.config, self.kubernetes, self.async_kubernetes, self.pci_inventory
         )
-        self.resources = Resources(self.config, self.kubernetes)
-
-    def find_pcidevice_by_address(self, all_node_pcidevices, address):
-        for device in all_node_pcidevices["items"]:
-            if "address" in device["status"]:
-                if device["status"]["address"] == address:
-                    return {
-                        "name": device["metadata"]["name"],
-                        "deviceName": device["status"]["resourceName"],
-                    }
-        return None
+        self.images = ImageCatalog(self.kubernetes)
+        if snapshot is not None:
+            # offline, images and pci devices as an earlier run saw them
+            self.images.images = snapshot["images"]
+            self.pci_inventory.index(snapshot["pcidevices"], snapshot["pcideviceclaims"])
+        self.existing_vms = {}
+        self.existing_secrets = {}
+
+    def close(self):
+        # the async client holds an aiohttp session and its own event loop
+        if self.async_kubernetes is not None:
+            self.async_kubernetes.close()
+            self.async_kubernetes = None
+        if self.rancher_owned:
+            self.rancher.close()
+
+    def get_snapshot(self):
+        # the lookup data rendering needs, to render again without the cluster
+        if self.images.images is None:
+            self.images.load()
+        self.load_pci_inventory()
+        return {
+            "images": self.images.images,
+            "pcidevices": self.pci_inventory.pcidevices_all,
+            "pcideviceclaims": self.pci_inventory.pcideviceclaims_all,
+        }
 
     def get_pcidevices(self, harvester_node, wanted_pcidevices):
         pcidevices = []
-        all_node_pcidevices = self.kubernetes.list_cluster(
-            "devices.harvesterhci.io",
-            "v1beta1",
-            "pcidevices",
-            f"nodename={harvester_node}",
-        )
         for wanted_pcidevice in wanted_pcidevices:
             if wanted_pcidevice in self.config["machines"]["pcidevices"]:
                 if "address" in self.config["machines"]["pcidevices"][wanted_pcidevice]:
                     for address in self.config["machines"]["pcidevices"][
                         wanted_pcidevice
                     ]["address"]:
-                        pcidevice = self.find_pcidevice_by_address(all_node_pcidevices, address)
+                        pcidevice = self.pci_inventory.find_by_address(harvester_node, address)
                         if pcidevice is not None:
                             pcidevices.append(pcidevice)
         return pcidevices
 
-
-
     def get_os_disk(self, vm, image_name):
-        image = self.kubernetes.list_cluster(
-            "harvesterhci.io",
-            "v1beta1",
-            "virtualmachineimages",
-            f"harvesterhci.io/imageDisplayName={image_name}",
-        )
+        image = self.images.get(image_name)
         return {
             "metadata": {
                 "name": f"{vm['name']}-disk-0",
                 "annotations": {
-                    "harvesterhci.io/imageId": f"{image['items'][0]['metadata']['namespace']}/{image['items'][0]['metadata']['name']}"
+                    "harvesterhci.io/imageId": f"{image['namespace']}/{image['name']}"
                 },
             },
             "spec": {
                 "accessModes": ["ReadWriteMany"],
                 "resources": {"requests": {"storage": f"{vm['disk_size']}Gi"}},
                 "volumeMode": "Block",
-                "storageClassName": f"{image['items'][0]['status']['storageClassName']}",
+                "storageClassName": f"{image['storageClassName']}",
             },
         }
 
@@ -87,35 +121,32 @@ class Harvester:
             },
         }
 
-    def create_csi_cloudconfig(self):
+    def create_csi_service_account(self):
+        # the service account is fetched once, its uid is needed for the token
         service_account_name = self.config["cluster"]["name"]
-        cluster_name = self.config["cluster"]["name"]
         namespace = self.config["machines"]["namespace"]
 
-        logging.info(f"Create CSI Cloudconfig for {cluster_name}")
+        logging.info(f"Create CSI Cloudconfig for {self.config['cluster']['name']}")
 
         self.kubernetes.create_namespace(namespace)
         self.kubernetes.create_service_account(namespace, service_account_name)
-        self.kubernetes.create_namespaced_cluster_role_binding(
-            namespace=namespace,
-            name=f"{namespace}-{service_account_name}-cloudprovider",
-            cluster_role_name="harvesterhci.io:cloudprovider",
-            service_account_name=service_account_name,
-        )
-        service_account = self.kubernetes.get_service_account(
+        return self.kubernetes.get_service_account(
             namespace=namespace, service_account_name=service_account_name
         )
+
+    def create_csi_role_binding(self, role):
+        service_account_name = self.config["cluster"]["name"]
+        namespace = self.config["machines"]["namespace"]
         self.kubernetes.create_namespaced_cluster_role_binding(
             namespace=namespace,
-            name=f"{namespace}-{service_account_name}-csi-driver",
-            cluster_role_name="harvesterhci.io:csi-driver",
+            name=f"{namespace}-{service_account_name}-{role}",
+            cluster_role_name=f"harvesterhci.io:{role}",
             service_account_name=service_account_name,
         )
-        service_account = self.kubernetes.get_service_account(
-            namespace=namespace, service_account_name=service_account_name
-        )
-
 
+    def create_csi_token(self, service_account):
+        service_account_name = self.config["cluster"]["name"]
+        namespace = self.config["machines"]["namespace"]
         service_account_token_name = f"{service_account_name}-token"
 
         self.kubernetes.create_service_account_token(
@@ -125,11 +156,18 @@ class Harvester:
             service_account_uid=service_account.metadata.uid,
         )
 
-        service_account_token = self.kubernetes.get_secret(
+        return self.kubernetes.get_secret(
             namespace=namespace, secret_name=service_account_token_name
         )
 
+    def get_vip(self):
         vip_config_map = self.kubernetes.get_config_map("harvester-system", "vip")
+        return vip_config_map.data["ip"]
+
+    def get_csi_kubeconfig(self, service_account_token, vip):
+        service_account_name = self.config["cluster"]["name"]
+        cluster_name = self.config["cluster"]["name"]
+        namespace = self.config["machines"]["namespace"]
 
         token = b64decode(service_account_token.data["token"])
 
@@ -139,120 +177,464 @@ class Harvester:
             context=f"{service_account_name}-{namespace}-{cluster_name}",
             user=f"{service_account_name}-{namespace}-{cluster_name}",
             token=token,
-            endpoint=f"https://{vip_config_map.data['ip']}:6443",
+            endpoint=f"https://{vip}:6443",
             ca_cert=service_account_token.data["ca.crt"],
         )
 
         return yaml.dump(kubeconfig)
 
-    def create_vms(self, updatevm=False, updatevm_names=""):
+    def create_csi_cloudconfig(self):
+        service_account = self.create_csi_service_account()
+        self.create_csi_role_binding("cloudprovider")
+        self.create_csi_role_binding("csi-driver")
+        service_account_token = self.create_csi_token(service_account)
+        return self.get_csi_kubeconfig(service_account_token, self.get_vip())
+
+    def add_csi_steps(self, graph):
+        # the role bindings, the token and the vip lookup only wait for what they use
+        service_account = graph.add(
+            "csi service account", self.create_csi_service_account, phase="csi"
+        )
+        requires = [
+            graph.add(
+                "csi cloudprovider binding",
+                lambda: self.create_csi_role_binding("cloudprovider"),
+                requires=[service_account],
+                phase="csi",
+            ),
+            graph.add(
+                "csi driver binding",
+                lambda: self.create_csi_role_binding("csi-driver"),
+                requires=[service_account],
+                phase="csi",
+            ),
+            graph.add(
+                "csi token",
+                lambda: self.create_csi_token(graph.results[service_account]),
+                requires=[service_account],
+                phase="csi",
+            ),
+            graph.add("vip", self.get_vip, phase="csi"),
+        ]
+        return graph.add(
+            "csi cloudconfig",
+            lambda: self.get_csi_kubeconfig(graph.results["csi token"], graph.results["vip"]),
+            requires=requires,
+            phase="csi",
+        )
+
+    def check_images(self):
+        # resolve all images up front, fail before any vm is touched
+        self.images.load()
+        errors = self.images.check(
+            [self.get_image_name(vm) for vm in self.config["machines"]["vms"]]
+        )
+        for error in errors:
+            logger.error(error)
+        if errors:
+            raise StepError(f"{len(errors)} image(s) not available")
+
+    def get_parallelism(self, parallelism=None):
+        if parallelism is None:
+            parallelism = self.config["machines"].get("parallelism", 1)
+        return max(int(parallelism), 1)
+
+    def create_cluster(self):
+        return self.rancher.create_cluster(self.blueprint)
+
+    def add_vm_steps(self, graph, updatevm=False, updatevm_names="", requires=None, cluster=None):
         if updatevm_names != "":
             updatevm_names = updatevm_names.split(",")
         else:
             updatevm_names = []
 
-        node_command = ""
-        csi_cloudconfig = ""
+        # images, pci devices, placement, node command, csi and the existing vms are
+        # independent of each other, only the node command waits for the downstream cluster
+        images = graph.add("images", self.check_images, phase="images")
+        pci_inventory = graph.add(
+            "pci devices", self.load_pci_inventory, phase="pci devices"
+        )
+        prepare_requires = [images, pci_inventory]
+        if self.config["machines"].get("auto_placement", False):
+            prepare_requires.append(
+                graph.add(
+                    "placement", self.place_vms, requires=[pci_inventory], phase="placement"
+                )
+            )
 
+        requires = list(requires or [])
+        requires.append(
+            graph.add("existing vms", self.load_existing_vms, phase="existing vms")
+        )
         if "rke2_provisioned_install" in self.config["kubernetes"]:
             if self.config["kubernetes"]["rke2_provisioned_install"]:
-                node_command = self.rancher.get_rke2_node_command(
-                    self.config["cluster"]["name"]
+                requires.append(
+                    graph.add(
+                        "node command",
+                        lambda: self.rancher.get_rke2_node_command(
+                            self.config["cluster"]["name"]
+                        ),
+                        requires=[cluster],
+                        phase="node command",
+                    )
                 )
             if self.config["kubernetes"]["install_harvester_csi"]:
-                csi_cloudconfig = self.create_csi_cloudconfig()
+                requires.append(self.add_csi_steps(graph))
 
+        # the vm manifests are rendered while the cluster is provisioned,
+        # the cloud-init secret needs the node command and is rendered last
+        prepared = {}
         for vm in self.config["machines"]["vms"]:
-            logger.info(f"Create VM {vm['name']}")
-            disks = []
-            pcidevices = []
-            if "pcidevices" in vm:
-            # TODO: Move this code to the resources module, to enable caching
-                pcidevices = self.get_pcidevices(vm["harvester_node"], vm["pcidevices"])
-            image_name = self.config["machines"]["template_image_name"]
-            if "type" in vm:
-                if vm["type"] == "gpu":
-                    image_name = self.config["machines"]["template_image_name_gpu"]
-
-            disks.append(self.get_os_disk(vm, image_name))
-            if "extra_disks" in vm:
-                count = 1
-                for disk in vm["extra_disks"]:
-                    disks.append(self.get_extra_disk(vm, disk, count))
-                    count += 1
-
-            template = Template("virtualmachine")
-            vm_manifest = template.parse(
-                blueprint=self.config,
-                vm=vm,
-                pcidevices=pcidevices,
-                disks=disks,
+            prepared[vm["name"]] = graph.add(
+                f"prepare vm {vm['name']}",
+                lambda vm=vm: self.prepare_vm(vm),
+                requires=prepare_requires,
             )
 
-            logger.debug(vm_manifest)
-
-            role = ""
-            if "role" in vm:
-                for r in vm["role"]:
-                    role = f"{role} --{r}".strip()
-
-            template = Template("user-data")
-            cloudinit_user_data = template.parse(
-                blueprint=self.config,
-                vm=vm,
-                csi_cloudconfig=csi_cloudconfig,
-                node_command=node_command,
-                role=role,
+        def get_inputs():
+            return (
+                graph.results.get("node command", ""),
+                graph.results.get("csi cloudconfig", ""),
             )
 
-            template = Template("network-data")
-            cloudinit_network_data = template.parse(
-                blueprint=self.config,
-                vm=vm,
+        if self.async_kubernetes is not None:
+            # a single step, the async client fans out over its own event loop; it needs
+            # the shared inputs and runs after every prepare step, a vm whose prepare
+            # step failed is reported failed without holding back the others
+            graph.add(
+                "vms",
+                lambda: self.async_kubernetes.run(
+                    self.create_vms_async(
+                        updatevm,
+                        updatevm_names,
+                        *get_inputs(),
+                        self.get_parallelism(),
+                        {
+                            name: graph.results[step]
+                            for name, step in prepared.items()
+                            if step in graph.results
+                        },
+                    )
+                ),
+                requires=requires + prepare_requires,
+                after=list(prepared.values()),
             )
+        else:
+            for vm in self.config["machines"]["vms"]:
+                graph.add(
+                    f"vm {vm['name']}",
+                    lambda vm=vm: self.create_vm(
+                        vm,
+                        updatevm,
+                        updatevm_names,
+                        *get_inputs(),
+                        graph.results[prepared[vm["name"]]],
+                    ),
+                    requires=requires + [prepared[vm["name"]]],
+                )
 
-            template = Template("cloudinit-secret")
-            cloudinit_secret = template.parse(
-                blueprint=self.config,
-                vm=vm,
-                cloudinit_user_data=cloudinit_user_data,
-                cloudinit_network_data=cloudinit_network_data,
-            )
+    def get_vm_summary(self, graph):
+        # report in blueprint order, independent of completion order
+        results = graph.results.get("vms", {})
+        summary = {}
+        for vm in self.config["machines"]["vms"]:
+            name = vm["name"]
+            summary[name] = results.get(name, graph.results.get(f"vm {name}", "failed"))
+        print_vm_summary(summary)
+        return summary
+
+    def create_vms(self, updatevm=False, updatevm_names="", parallelism=None):
+        graph = StepGraph()
+        self.add_vm_steps(graph, updatevm, updatevm_names)
+        graph.run(self.get_parallelism(parallelism))
+        self.save_state()
+        if not graph.succeeded("images"):
+            return None
+        return self.get_vm_summary(graph)
+
+    def place_vms(self):
+        # fill in harvester_node for unpinned vms, based on the live free capacity
+        placement = Placement(self.config, self.get_resources())
+        unplaced = placement.place(self.config["machines"]["vms"])
+        if unplaced:
+            logger.warning(f"VMs without a node: {', '.join(unplaced)}")
+
+    def load_existing_vms(self):
+        # one list call for all vms and cloud-init secrets instead of a get per vm
+        namespace = self.config["machines"]["namespace"]
+        if "cluster" not in self.config:
+            # create namespace if vm only provisioning
+            self.kubernetes.create_namespace(namespace)
+        vms = self.kubernetes.list(
+            "kubevirt.io",
+            "v1",
+            "virtualmachines",
+            namespace=namespace,
+        )
+        self.existing_vms = {vm["metadata"]["name"]: vm for vm in vms["items"]}
+        secrets = self.kubernetes.list_secret(
+            namespace, "harvesterhci.io/cloud-init-template=harvester"
+        )
+        self.existing_secrets = {
+            secret["metadata"]["name"]: secret for secret in secrets["items"]
+        }
+
+    async def create_vms_async(
+        self,
+        updatevm,
+        updatevm_names,
+        node_command,
+        csi_cloudconfig,
+        parallelism,
+        prepared=None,
+    ):
+        # prepared holds the vms prepared by their own step, the others failed to prepare;
+        # without it every vm is prepared here
+        async def create(vm):
+            if prepared is not None and vm["name"] not in prepared:
+                logger.error(f"Failed to prepare VM {vm['name']}")
+                return vm["name"], "failed"
+            try:
+                return vm["name"], await self.create_vm_async(
+                    vm,
+                    updatevm,
+                    updatevm_names,
+                    node_command,
+                    csi_cloudconfig,
+                    None if prepared is None else prepared[vm["name"]],
+                )
+            except Exception as e:
+                logger.error(f"Failed to create VM {vm['name']}: {e}")
+                return vm["name"], "failed"
+
+        results = await self.async_kubernetes.gather(
+            [create(vm) for vm in self.config["machines"]["vms"]], limit=parallelism
+        )
+        return dict(results)
+
+    def prepare_vm(self, vm):
+        # everything of a vm that does not depend on the downstream cluster, the manifest
+        # is not rendered when the state shows it was applied from the same inputs
+        with phase("vm", vm["name"]):
+            pcidevices, disks = self.get_vm_lookups(vm)
+            prepared = {
+                "pcidevices": pcidevices,
+                "disks": disks,
+                "inputs": self.get_vm_inputs(vm, pcidevices, disks),
+                "manifest": None,
+            }
+            if prepared["inputs"] is None or (
+                prepared["inputs"] != self.get_vm_state(vm).get("vm_inputs")
+            ):
+                prepared["manifest"] = render_vm_manifest(self.config, vm, pcidevices, disks)
+            return prepared
 
-            if "cluster" not in self.config:
-                # create namespace if vm only provisioning
-                self.kubernetes.create_namespace(self.config["machines"]["namespace"])
+    def get_vm_lookups(self, vm):
+        pcidevices = []
+        if "pcidevices" in vm:
+            pcidevices = self.get_pcidevices(vm["harvester_node"], vm["pcidevices"])
+        disks = self.get_disks(vm, self.get_os_disk(vm, self.get_image_name(vm)))
+        return pcidevices, disks
+
+    def get_config_fingerprint(self):
+        # the config every vm is rendered with, the other vms of the blueprint don't count
+        if self.config_fingerprint is None:
+            machines = {k: v for k, v in self.config["machines"].items() if k != "vms"}
+            self.config_fingerprint = fingerprint({**self.config, "machines": machines})
+        return self.config_fingerprint
+
+    def get_vm_inputs(self, vm, pcidevices, disks):
+        if self.state is None:
+            return None
+        return fingerprint(
+            self.get_config_fingerprint(),
+            get_template_hash("virtualmachine"),
+            vm,
+            pcidevices,
+            disks,
+        )
+
+    def get_secret_inputs(self, vm, node_command, csi_cloudconfig):
+        if self.state is None:
+            return None
+        return fingerprint(
+            self.get_config_fingerprint(),
+            [get_template_hash(name) for name in ["user-data", "network-data", "cloudinit-secret"]],
+            vm,
+            node_command,
+            csi_cloudconfig,
+        )
 
-            vminfo = self.kubernetes.get(
-                "kubevirt.io",
-                "v1",
-                "virtualmachines",
-                vm["name"],
-                namespace=self.config["machines"]["namespace"],
+    def get_vm_state(self, vm):
+        if self.state is None:
+            return {}
+        return self.state.get(vm["name"])
+
+    def get_vm_manifests(self, vm, vminfo, node_command, csi_cloudconfig, prepared):
+        # stamped cloud-init secret and vm manifest with the state entry they produce, None when
+        # both were applied from the same inputs and still carry the hashes of that run
+        entry = {
+            "vm_inputs": prepared["inputs"],
+            "secret_inputs": self.get_secret_inputs(vm, node_command, csi_cloudconfig),
+        }
+        state = self.get_vm_state(vm)
+        if (
+            self.state is not None
+            and entry["vm_inputs"] == state.get("vm_inputs")
+            and entry["secret_inputs"] == state.get("secret_inputs")
+            and get_manifest_hash(vminfo) == state.get("vm_hash")
+            and get_manifest_hash(self.existing_secrets.get(vm["name"]))
+            == state.get("secret_hash")
+        ):
+            return None
+
+        vm_manifest = prepared["manifest"]
+        if vm_manifest is None:
+            vm_manifest = render_vm_manifest(
+                self.config, vm, prepared["pcidevices"], prepared["disks"]
             )
+        cloudinit_secret = render_cloudinit_secret(
+            self.config, vm, node_command, csi_cloudconfig
+        )
+        cloudinit_secret, entry["secret_hash"] = stamp_manifest_hash(cloudinit_secret)
+        vm_manifest, entry["vm_hash"] = stamp_manifest_hash(vm_manifest)
+        return cloudinit_secret, vm_manifest, entry
 
-            if (
-                vminfo is None
-                or (updatevm and vm["name"] in updatevm_names)
-                or (updatevm and updatevm_names == [])
-            ):
-                logging.warning(f"Updating {vm['name']}")
-                result = self.kubernetes.create(
-                    cloudinit_secret, self.config["machines"]["namespace"]
+    def record_vm(self, vm, status, entry):
+        if self.state is not None and status != "failed":
+            self.state.set(vm["name"], entry)
+
+    def save_state(self):
+        if self.state is None:
+            return
+        self.state.prune({vm["name"] for vm in self.config["machines"]["vms"]})
+        self.state.save()
+
+    def plan_vm(self, vm, updatevm, updatevm_names, node_command, csi_cloudconfig, prepared):
+        # the status of a vm that needs no apply, or the manifests to apply with the
+        # objects they replace and the state entry they produce
+        logger.info(f"Create VM {vm['name']}")
+        vminfo = self.existing_vms.get(vm["name"])
+
+        if not self.should_apply_vm(vm, vminfo, updatevm, updatevm_names):
+            logger.warning(f"VM {vm['name']} already exists")
+            return "skipped", vminfo, None, None
+
+        manifests = self.get_vm_manifests(vm, vminfo, node_command, csi_cloudconfig, prepared)
+        if manifests is None:
+            logger.info(f"VM {vm['name']} is unchanged since the last run")
+            return "unchanged", vminfo, None, None
+        cloudinit_secret, vm_manifest, entry = manifests
+
+        logging.warning(f"Updating {vm['name']}")
+        # current state comes from the snapshot, no need to look it up again
+        applies = [
+            (cloudinit_secret, self.existing_secrets.get(vm["name"])),
+            (vm_manifest, vminfo),
+        ]
+        return None, vminfo, applies, entry
+
+    def finish_vm(self, vm, vminfo, results, entry):
+        status = self.get_apply_status(vm, vminfo, results)
+        self.record_vm(vm, status, entry)
+        return status
+
+    def create_vm(
+        self, vm, updatevm, updatevm_names, node_command, csi_cloudconfig, prepared=None
+    ):
+        if prepared is None:
+            prepared = self.prepare_vm(vm)
+        with phase("vm", vm["name"]):
+            status, vminfo, applies, entry = self.plan_vm(
+                vm, updatevm, updatevm_names, node_command, csi_cloudconfig, prepared
+            )
+            if status is not None:
+                return status
+            results = [
+                self.kubernetes.apply(
+                    manifest, self.config["machines"]["namespace"], current=current, lookup=False
                 )
-                if result:
-                    print(result)
-                result = self.kubernetes.create(
-                    vm_manifest, self.config["machines"]["namespace"]
+                for manifest, current in applies
+            ]
+            return self.finish_vm(vm, vminfo, results, entry)
+
+    async def create_vm_async(
+        self, vm, updatevm, updatevm_names, node_command, csi_cloudconfig, prepared=None
+    ):
+        if prepared is None:
+            prepared = self.prepare_vm(vm)
+        with phase("vm", vm["name"]):
+            status, vminfo, applies, entry = self.plan_vm(
+                vm, updatevm, updatevm_names, node_command, csi_cloudconfig, prepared
+            )
+            if status is not None:
+                return status
+            # applied one after the other, the secret has to exist before the vm
+            results = [
+                await self.async_kubernetes.apply(
+                    manifest, self.config["machines"]["namespace"], current=current, lookup=False
                 )
-                if result:
-                    print(result)
-            else:
-                logger.warning(f"VM {vm['name']} already exists")
+                for manifest, current in applies
+            ]
+            return self.finish_vm(vm, vminfo, results, entry)
+
+    def should_apply_vm(self, vm, vminfo, updatevm, updatevm_names):
+        return (
+            vminfo is None
+            or (updatevm and vm["name"] in updatevm_names)
+            or (updatevm and updatevm_names == [])
+        )
+
+    def get_apply_status(self, vm, vminfo, results):
+        status = "created" if vminfo is None else "updated"
+        if not any(applied for applied, error in results):
+            logger.info(f"VM {vm['name']} is unchanged")
+            status = "unchanged"
+        for applied, error in results:
+            if error:
+                print(error)
+                status = "failed"
+        return status
+
+    def get_image_name(self, vm):
+        image_name = self.config["machines"]["template_image_name"]
+        if "type" in vm:
+            if vm["type"] == "gpu":
+                image_name = self.config["machines"]["template_image_name_gpu"]
+        return image_name
+
+    def get_disks(self, vm, os_disk):
+        disks = [os_disk]
+        if "extra_disks" in vm:
+            count = 1
+            for disk in vm["extra_disks"]:
+                disks.append(self.get_extra_disk(vm, disk, count))
+                count += 1
+        return disks
+
+    def load_pci_inventory(self):
+        if not self.pci_inventory.loaded:
+            self.pci_inventory.load()
 
     def get_resources(self):
+        self.load_pci_inventory()
         return self.resources.get()
 
+    def get_network_cidr(self):
+        return str(IPv4Network(
+            f"{self.config['network']['gateway']}/{self.config['network']['netmask']}", False))
+
+    def render_vm_network(self):
+        namespace = self.config["network"]["name"].split("/")[0]
+        name = self.config["network"]["name"].split("/")[1]
+        template = Template("network-attachment-definition")
+        return template.parse(
+            blueprint = self.config,
+            name = name,
+            namespace = namespace,
+            cidr = self.get_network_cidr()
+        )
+
     def create_vm_network(self):
         if "vlan_id" not in self.config["network"]:
             logger.warning("No vlan_id configured, vlan won't be provisioned")
@@ -265,16 +647,8 @@ class Harvester:
             "network-attachment-definitions",
             name,
             namespace=namespace)
-        cidr = str(IPv4Network(
-            f"{self.config['network']['gateway']}/{self.config['network']['netmask']}", False))
         if network is None:
-            template = Template("network-attachment-definition")
-            network_attachment_definition_manifest = template.parse(
-                blueprint = self.config,
-                name = name,
-                namespace = namespace,
-                cidr = cidr
-            )
+            network_attachment_definition_manifest = self.render_vm_network()
             logger.info(f"Create network {name} in namespace {namespace}")
             result = self.kubernetes.create(network_attachment_definition_manifest, namespace)
             if result:
@@ -282,25 +656,29 @@ class Harvester:
         else:
             logger.warning(f"Network {name} in namespace {namespace} already exists")
 
+    def get_ip_pool_name(self):
+        return f"{self.config['cluster']['name']}-ip-pool"
+
+    def render_ip_pool(self):
+        template = Template("ip-pool")
+        return template.parse(
+            blueprint = self.config,
+            name = self.get_ip_pool_name(),
+            cidr = self.get_network_cidr()
+        )
+
     def create_ip_pool(self):
         if "ip_pool" not in self.config["network"]:
             logger.warning(f"No IP Pool configured")
             return
-        name = f"{self.config['cluster']['name']}-ip-pool"
-        cidr = str(IPv4Network(
-            f"{self.config['network']['gateway']}/{self.config['network']['netmask']}", False))
+        name = self.get_ip_pool_name()
         ip_pool = self.kubernetes.get(
             "loadbalancer.harvesterhci.io",
             "v1beta1",
             "ippools",
             name)
         if ip_pool is None:
-            template = Template("ip-pool")
-            ip_pool_manifest = template.parse(
-                blueprint = self.config,
-                name = name,
-                cidr = cidr
-            )
+            ip_pool_manifest = self.render_ip_pool()
             logger.info(f"Create IP Pool {name}")
             result = self.kubernetes.create(ip_pool_manifest)
             if result:
@@ -308,7 +686,74 @@ class Harvester:
         else:
             logger.warning(f"IP Pool {name} already exists")
 
-    def provision(self, args):
-        self.create_vm_network()
-        self.create_ip_pool()
-        self.create_vms(args.updatevm, args.vms)
+    def render(self, output, processes=None, template_cache=None):
+        # every manifest provisioning would apply, without changing the cluster; the node
+        # command and the csi cloud config are created by provisioning and left empty
+        manifests = []
+        if "vlan_id" in self.config["network"]:
+            name = self.config["network"]["name"].split("/")[1]
+            manifests.append(
+                (f"network-attachment-definition-{name}.yaml", self.render_vm_network())
+            )
+        if "ip_pool" in self.config["network"]:
+            manifests.append((f"ip-pool-{self.get_ip_pool_name()}.yaml", self.render_ip_pool()))
+
+        if self.images.images is None:
+            self.images.load()
+        self.load_pci_inventory()
+        errors = self.images.check(
+            [self.get_image_name(vm) for vm in self.config["machines"]["vms"]]
+        )
+        for error in errors:
+            logger.error(error)
+        if errors:
+            return None
+        if self.config["machines"].get("auto_placement", False):
+            logger.warning("Auto placement needs the live capacity and is not applied")
+
+        # a vm that can not be rendered fails the whole render, not just its own manifests
+        unplaced = [
+            vm["name"]
+            for vm in self.config["machines"]["vms"]
+            if "pcidevices" in vm and "harvester_node" not in vm
+        ]
+        if unplaced:
+            for name in unplaced:
+                logger.error(f"VM {name} has pcidevices but no harvester_node")
+            return None
+        tasks = [
+            (vm, *self.get_vm_lookups(vm), "", "") for vm in self.config["machines"]["vms"]
+        ]
+        with phase("render"):
+            rendered = render_vms(self.config, tasks, processes, template_cache)
+        for name, cloudinit_secret, vm_manifest in rendered:
+            manifests.append((f"{name}-cloudinit-secret.yaml", cloudinit_secret))
+            manifests.append((f"{name}-virtualmachine.yaml", vm_manifest))
+        write_manifests(manifests, output)
+        return manifests
+
+    def get_provision_graph(self, args, update_cluster=False):
+        graph = StepGraph()
+        cluster = None
+        if update_cluster:
+            # rancher provisions the downstream cluster while the harvester side is prepared
+            cluster = graph.add(
+                "cluster", self.create_cluster, phase="cluster", background=True
+            )
+        network = graph.add("network", self.create_vm_network, phase="network")
+        graph.add("ip pool", self.create_ip_pool, phase="ip pool")
+        # vms reference the network, everything else runs next to it
+        self.add_vm_steps(
+            graph, args.updatevm, args.vms, requires=[network], cluster=cluster
+        )
+        return graph
+
+    def provision(self, args, update_cluster=False):
+        graph = self.get_provision_graph(args, update_cluster)
+        if args.plan:
+            print(graph.format_plan())
+            return
+        graph.run(self.get_parallelism(args.parallel))
+        self.save_state()
+        if graph.succeeded("images"):
+            self.get_vm_summary(graph)
@@ -0,0 +1,52 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# all virtualmachineimages of the cluster, fetched once and indexed by display name
+class ImageCatalog:
+
+    def __init__(self, kubernetes):
+        self.kubernetes = kubernetes
+        self.images = None
+
+    def load(self):
+        self.images = {}
+        images = self.kubernetes.list_cluster(
+            "harvesterhci.io",
+            "v1beta1",
+            "virtualmachineimages",
+        )
+        if images is None:
+            return self.images
+        for image in images["items"]:
+            display_name = image["spec"].get(
+                "displayName",
+                image["metadata"].get("labels", {}).get("harvesterhci.io/imageDisplayName"),
+            )
+            status = image.get("status", {})
+            self.images[display_name] = {
+                "namespace": image["metadata"]["namespace"],
+                "name": image["metadata"]["name"],
+                "storageClassName": status.get("storageClassName", ""),
+                "progress": status.get("progress", 0),
+            }
+        logger.debug(f"Loaded {len(self.images)} virtualmachineimages")
+        return self.images
+
+    def get(self, display_name):
+        if self.images is None:
+            self.load()
+        return self.images.get(display_name)
+
+    def check(self, display_names):
+        errors = []
+        for display_name in sorted(set(display_names)):
+            image = self.get(display_name)
+            if image is None:
+                errors.append(f"Image {display_name} not found")
+            elif image["progress"] != 100 or image["storageClassName"] == "":
+                errors.append(
+                    f"Image {display_name} is not ready (download progress {image['progress']}%)"
+                )
+        return errors
@@ -0,0 +1,262 @@
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter
+from .resources import Resources
+from .pcidevices import PciInventory
+
+import json
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+WATCH_TIMEOUT = 300
+# how often an optional resource type that is not installed is looked for again
+MISSING_RETRY = 60
+
+
+def get_metadata(obj, field):
+    if isinstance(obj, dict):
+        return obj["metadata"].get(field)
+    return getattr(obj.metadata, field)
+
+
+# keeps a local copy of one resource type, listed once and then updated from a watch stream
+class Informer(threading.Thread):
+    def __init__(self, name, list_function, on_change, transform=None, optional=False, **kwargs):
+        super().__init__(name=f"informer-{name}", daemon=True)
+        self.resource_name = name
+        self.list_function = list_function
+        self.kwargs = kwargs
+        self.on_change = on_change
+        self.transform = transform
+        # the resource type may not be installed, e.g. the crds of an addon
+        self.optional = optional
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.synced = threading.Event()
+        self.stopped = threading.Event()
+
+    def get_key(self, obj):
+        return (get_metadata(obj, "namespace"), get_metadata(obj, "name"))
+
+    def get_value(self, obj):
+        if self.transform is None:
+            return obj
+        return self.transform(obj)
+
+    def relist(self):
+        result = self.list_function(**self.kwargs)
+        if isinstance(result, dict):
+            items = result["items"]
+            resource_version = result["metadata"]["resourceVersion"]
+        else:
+            items = result.items
+            resource_version = result.metadata.resource_version
+        objects = {self.get_key(obj): self.get_value(obj) for obj in items}
+        with self.lock:
+            self.objects = objects
+        logger.info(f"Listed {len(objects)} {self.resource_name}")
+        self.synced.set()
+        self.on_change()
+        return resource_version
+
+    def set_missing(self):
+        # a missing resource type has no objects, the inventory does not wait for it
+        with self.lock:
+            changed = bool(self.objects)
+            self.objects = {}
+        if not self.synced.is_set():
+            logger.info(f"No {self.resource_name} on the cluster, retrying in {MISSING_RETRY}s")
+            self.synced.set()
+            changed = True
+        if changed:
+            self.on_change()
+
+    def watch(self, resource_version):
+        stream = watch.Watch()
+        while not self.stopped.is_set():
+            for event in stream.stream(
+                self.list_function,
+                resource_version=resource_version,
+                timeout_seconds=WATCH_TIMEOUT,
+                **self.kwargs,
+            ):
+                if event["type"] == "BOOKMARK":
+                    continue
+                obj = event["object"]
+                key = self.get_key(obj)
+                with self.lock:
+                    if event["type"] == "DELETED":
+                        self.objects.pop(key, None)
+                    else:
+                        self.objects[key] = self.get_value(obj)
+                self.on_change()
+            resource_version = stream.resource_version
+
+    def run(self):
+        backoff = 1
+        while not self.stopped.is_set():
+            try:
+                resource_version = self.relist()
+                backoff = 1
+                self.watch(resource_version)
+            except ApiException as e:
+                if e.status == 410:
+                    logger.debug(f"Watch on {self.resource_name} expired, relisting")
+                    continue
+                if e.status == 404 and self.optional:
+                    self.set_missing()
+                    self.stopped.wait(MISSING_RETRY)
+                    continue
+                logger.warning(f"Watch on {self.resource_name} failed: {e.reason}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+            except Exception as e:
+                logger.warning(f"Watch on {self.resource_name} failed: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+    def list(self):
+        with self.lock:
+            return list(self.objects.values())
+
+    def stop(self):
+        self.stopped.set()
+
+
+# in memory inventory of nodes, vmis, pods and pci devices, serving the data of Resources.get
+class Inventory:
+    def __init__(self, config, kubernetes):
+        self.config = config
+        self.kubernetes = kubernetes
+        self.pci_inventory = PciInventory(kubernetes)
+        self.resources = Resources(config, kubernetes, pci_inventory=self.pci_inventory)
+        self.version = 0
+        self.version_lock = threading.Lock()
+        self.report_lock = threading.Lock()
+        self.report = None
+        self.report_json = None
+        self.report_version = -1
+
+        core_api = client.CoreV1Api(kubernetes.api_client)
+        custom_api = client.CustomObjectsApi(kubernetes.api_client)
+        self.informers = {
+            "nodes": Informer("nodes", core_api.list_node, self.changed),
+            "pods": Informer(
+                "pods",
+                core_api.list_pod_for_all_namespaces,
+                self.changed,
+                # only the node is needed to count pods
+                transform=lambda pod: pod.spec.node_name,
+            ),
+            "virtualmachineinstances": Informer(
+                "virtualmachineinstances",
+                custom_api.list_cluster_custom_object,
+                self.changed,
+                group="kubevirt.io",
+                version="v1",
+                plural="virtualmachineinstances",
+            ),
+            "pcidevices": Informer(
+                "pcidevices",
+                custom_api.list_cluster_custom_object,
+                self.changed,
+                group="devices.harvesterhci.io",
+                version="v1beta1",
+                plural="pcidevices",
+                optional=True,
+            ),
+            "pcideviceclaims": Informer(
+                "pcideviceclaims",
+                custom_api.list_cluster_custom_object,
+                self.changed,
+                group="devices.harvesterhci.io",
+                version="v1beta1",
+                plural="pcideviceclaims",
+                optional=True,
+            ),
+        }
+
+    def changed(self):
+        with self.version_lock:
+            self.version += 1
+
+    def start(self):
+        for informer in self.informers.values():
+            informer.start()
+
+    def stop(self):
+        for informer in self.informers.values():
+            informer.stop()
+
+    def is_synced(self):
+        return all(informer.synced.is_set() for informer in self.informers.values())
+
+    def get(self):
+        # the report is only rebuilt when an informer has seen a change since the last request
+        with self.report_lock:
+            version = self.version
+            if self.report_version != version:
+                self.pci_inventory.index(
+                    {"items": self.informers["pcidevices"].list()},
+                    {"items": self.informers["pcideviceclaims"].list()},
+                )
+                nodes_data = self.resources.group_by_node(
+                    {"items": self.informers["virtualmachineinstances"].list()},
+                    Counter(self.informers["pods"].list()),
+                )
+                self.report = self.resources.get(
+                    nodes=self.informers["nodes"].list(),
+                    nodes_data=nodes_data,
+                )
+                self.report_json = json.dumps(self.report, sort_keys=True).encode("utf-8")
+                self.report_version = version
+            return self.report
+
+    def get_json(self):
+        self.get()
+        return self.report_json
+
+
+class InventoryRequestHandler(BaseHTTPRequestHandler):
+    inventory = None
+
+    def send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            if self.inventory.is_synced():
+                self.send(200, "text/plain", b"ok\n")
+            else:
+                self.send(503, "text/plain", b"syncing\n")
+        elif self.path == "/resources":
+            if not self.inventory.is_synced():
+                self.send(503, "text/plain", b"syncing\n")
+            else:
+                self.send(200, "application/json", self.inventory.get_json())
+        else:
+            self.send(404, "text/plain", b"not found\n")
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+def serve(inventory, address, port, handler=InventoryRequestHandler, **attributes):
+    handler = type(handler.__name__, (handler,), {"inventory": inventory, **attributes})
+    server = ThreadingHTTPServer((address, port), handler)
+    logger.info(f"Serving inventory on http://{address}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        inventory.stop()
@@ -1,33 +1,191 @@
-from kubernetes import client, config, utils
+from kubernetes import client, config, watch
 from kubernetes.client.rest import ApiException
+from kubernetes.dynamic import DynamicClient
+from kubernetes.dynamic.exceptions import DynamicApiError, NotFoundError
 from .utils import print_api_error
+from .profiler import get_profiler, instrument_rest_client, measure, profiled
 
+from collections import Counter
+from types import SimpleNamespace
+
+import hashlib
+import inspect
+import json
+import threading
 import yaml
 
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+FIELD_MANAGER = "python-rancher-harvester"
+TABLE = "application/json;as=Table;g=meta.k8s.io;v=v1,application/json"
+PAGE_SIZE = 500
+MANIFEST_HASH_ANNOTATION = "python-rancher-harvester/manifest-hash"
+
+
+def manifest_hash(manifest):
+    # a manifest that is already stamped hashes like the unstamped one
+    annotations = manifest.get("metadata", {}).get("annotations") or {}
+    if MANIFEST_HASH_ANNOTATION in annotations:
+        metadata = dict(manifest["metadata"])
+        metadata.pop("annotations")
+        annotations = {k: v for k, v in annotations.items() if k != MANIFEST_HASH_ANNOTATION}
+        if annotations:
+            metadata["annotations"] = annotations
+        manifest = {**manifest, "metadata": metadata}
+    return hashlib.sha256(
+        json.dumps(manifest, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def stamp_manifest_hash(manifest):
+    if not isinstance(manifest, dict):
+        with measure("yaml", "safe_load") as event:
+            if event is not None:
+                event.size = len(manifest)
+            manifest = yaml.safe_load(manifest)
+    content_hash = manifest_hash(manifest)
+    manifest.setdefault("metadata", {})
+    if manifest["metadata"].get("annotations") is None:
+        manifest["metadata"]["annotations"] = {}
+    manifest["metadata"]["annotations"][MANIFEST_HASH_ANNOTATION] = content_hash
+    return manifest, content_hash
+
+
+def project_node(node):
+    # only the fields Resources uses, shaped like the client models
+    status = node.get("status", {})
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name=node["metadata"]["name"]),
+        status=SimpleNamespace(
+            capacity=status.get("capacity", {}),
+            allocatable=status.get("allocatable", {}),
+        ),
+    )
+
+
+def project_list(response, project):
+    return SimpleNamespace(items=[project(item) for item in json_loads(response.data)["items"]])
+
+
+def get_pod_nodes(page):
+    # node names of a page of pods, from the table columns or the full pods when the
+    # server does not answer with a table
+    if page.get("kind") == "Table":
+        column = [c["name"] for c in page["columnDefinitions"]].index("Node")
+        return [
+            None if row["cells"][column] in ("", "<none>") else row["cells"][column]
+            for row in page["rows"]
+        ]
+    return [pod["spec"].get("nodeName") for pod in page["items"]]
+
+
+def get_manifest_hash(obj):
+    if obj is None:
+        return None
+    annotations = obj.get("metadata", {}).get("annotations") or {}
+    return annotations.get(MANIFEST_HASH_ANNOTATION)
+
+
+def on_unauthorized(rest_client, callback):
+    # call back when the credentials of the kubeconfig are rejected, e.g. a revoked token
+    request = rest_client.request
+
+    if inspect.iscoroutinefunction(request):
+
+        async def async_checked_request(*args, **kwargs):
+            try:
+                response = await request(*args, **kwargs)
+            except Exception as e:
+                # kubernetes_asyncio raises its own ApiException
+                if getattr(e, "status", None) == 401:
+                    callback()
+                raise
+            if getattr(response, "status", None) == 401:
+                callback()
+            return response
+
+        rest_client.request = async_checked_request
+        return
+
+    def checked_request(*args, **kwargs):
+        try:
+            response = request(*args, **kwargs)
+        except ApiException as e:
+            if e.status == 401:
+                callback()
+            raise
+        if getattr(response, "status", None) == 401:
+            callback()
+        return response
+
+    rest_client.request = checked_request
+
 
 class Kubernetes:
-    def __init__(self, kubeconfig):
+    def __init__(self, kubeconfig, unauthorized=None):
         configuration = client.Configuration()
         config.load_kube_config_from_dict(
             kubeconfig, client_configuration=configuration
         )
         self.api_client = client.ApiClient(configuration=configuration)
+        if get_profiler() is not None:
+            instrument_rest_client(self.api_client.rest_client)
+        if unauthorized is not None:
+            on_unauthorized(self.api_client.rest_client, unauthorized)
+        self.dynamic_client = None
+        self.dynamic_client_lock = threading.Lock()
 
+    def get_dynamic_client(self):
+        with self.dynamic_client_lock:
+            if self.dynamic_client is None:
+                self.dynamic_client = DynamicClient(self.api_client)
+        return self.dynamic_client
+
+    # measured as the apply it makes
     def create(self, manifest, namespace=None):
-        if not isinstance(manifest, dict):
-            manifest = yaml.safe_load(manifest)
+        applied, error = self.apply(manifest, namespace)
+        return error
+
+    @profiled("kubernetes")
+    def apply(self, manifest, namespace=None, current=None, lookup=True):
+        # server side apply, skipped when the object already carries the hash of this manifest
+        # current is the object as it is in the cluster, looked up when not given and lookup is set
+        manifest, content_hash = stamp_manifest_hash(manifest)
+        dynamic_client = self.get_dynamic_client()
         try:
-            utils.create_from_dict(
-                k8s_client=self.api_client,
-                data=manifest,
-                verbose=False,
+            resource = dynamic_client.resources.get(
+                api_version=manifest["apiVersion"], kind=manifest["kind"]
+            )
+            if not resource.namespaced:
+                namespace = None
+            elif namespace is None:
+                namespace = manifest["metadata"].get("namespace")
+            if current is None and lookup:
+                try:
+                    current = dynamic_client.get(
+                        resource, name=manifest["metadata"]["name"], namespace=namespace
+                    ).to_dict()
+                except NotFoundError:
+                    current = None
+            if get_manifest_hash(current) == content_hash:
+                return False, None
+            dynamic_client.server_side_apply(
+                resource,
+                body=manifest,
                 namespace=namespace,
-                apply=True,
+                field_manager=FIELD_MANAGER,
+                force_conflicts=True,
             )
-        except utils.FailToCreateError as e:
-            return str(e)
-        return None
+        except DynamicApiError as e:
+            return False, str(e)
+        return True, None
 
+    @profiled("kubernetes")
     def list_cluster(self, group, version, plural, label_selector=""):
         api = client.CustomObjectsApi(self.api_client)
         try:
@@ -46,6 +204,7 @@ class Kubernetes:
 
 
 
+    @profiled("kubernetes")
     def list(self, group, version, plural, label_selector="", namespace=None):
         api = client.CustomObjectsApi(self.api_client)
         if namespace is None:
@@ -64,13 +223,34 @@ class Kubernetes:
                 label_selector=label_selector,
             )
 
-    def list_node(self):
+    def watch(self, group, version, plural, name, namespace, timeout_seconds=60):
+        # yields (event type, object) for a single named custom object until the server closes the watch
+        api = client.CustomObjectsApi(self.api_client)
+        stream = watch.Watch().stream(
+            api.list_namespaced_custom_object,
+            group=group,
+            version=version,
+            namespace=namespace,
+            plural=plural,
+            field_selector=f"metadata.name={name}",
+            timeout_seconds=timeout_seconds,
+        )
+        for event in stream:
+            yield event["type"], event["object"]
+
+    # raw=True skips the model deserialization and returns only the fields
+    # used by Resources (name, capacity, allocatable)
+    @profiled("kubernetes")
+    def list_node(self, raw=False):
         api = client.CoreV1Api(self.api_client)
         try:
+            if raw:
+                return project_list(api.list_node(_preload_content=False), project_node)
             return api.list_node()
         except ApiException as e:
             print_api_error(e)
 
+    @profiled("kubernetes")
     def list_pod(self, namespace="", field_selector="", label_selector=""):
         api = client.CoreV1Api(self.api_client)
         try:
@@ -87,6 +267,7 @@ class Kubernetes:
         except ApiException as e:
             print_api_error(e)
 
+    @profiled("kubernetes")
     def list_all_pods(self, node = None):
         api = client.CoreV1Api(self.api_client)
         try:
@@ -97,6 +278,37 @@ class Kubernetes:
         except ApiException as e:
             print_api_error(e)
 
+    def list_pages(self, accept, field_selector=None, page_size=PAGE_SIZE):
+        # chunked pod list (limit/continue) as raw json, only one page is held in memory
+        api = client.CoreV1Api(self.api_client)
+        _continue = None
+        while True:
+            response = api.list_pod_for_all_namespaces(
+                field_selector=field_selector,
+                limit=page_size,
+                _continue=_continue,
+                _preload_content=False,
+                _headers={"Accept": accept},
+            )
+            page = json_loads(response.data)
+            yield page
+            _continue = page["metadata"].get("continue")
+            if not _continue:
+                return
+
+    @profiled("kubernetes")
+    def list_pod_nodes(self, page_size=PAGE_SIZE):
+        # pods per node, read from the table columns instead of full pod objects and
+        # counted page by page so only one page is held at a time
+        nodes = Counter()
+        try:
+            for page in self.list_pages(TABLE, page_size=page_size):
+                nodes.update(get_pod_nodes(page))
+        except ApiException as e:
+            print_api_error(e)
+        return nodes
+
+    @profiled("kubernetes")
     def get(self, group, version, plural, name, label_selector=None, namespace=None):
         api = client.CustomObjectsApi(self.api_client)
         try:
@@ -141,6 +353,7 @@ class Kubernetes:
             else:
                 print_api_error(e)
 
+    @profiled("kubernetes")
     def create_namespace(self, namespace):
         api = client.CoreV1Api(self.api_client)
         try:
@@ -150,6 +363,7 @@ class Kubernetes:
         except ApiException as e:
             print_api_error(e)
 
+    @profiled("kubernetes")
     def create_service_account(self, namespace, name):
         api = client.CoreV1Api(self.api_client)
         try:
@@ -160,6 +374,7 @@ class Kubernetes:
         except ApiException as e:
             print_api_error(e)
 
+    @profiled("kubernetes")
     def create_namespaced_cluster_role_binding(
         self, namespace, name, cluster_role_name, service_account_name
     ):
@@ -186,12 +401,14 @@ class Kubernetes:
         except ApiException as e:
             print_api_error(e)
 
+    @profiled("kubernetes")
     def get_service_account(self, namespace, service_account_name):
         api = client.CoreV1Api(self.api_client)
         return api.read_namespaced_service_account(
             namespace=namespace, name=service_account_name
         )
 
+    @profiled("kubernetes")
     def create_service_account_token(
         self, namespace, name, service_account_name, service_account_uid
     ):
@@ -222,10 +439,25 @@ class Kubernetes:
         except ApiException as e:
             print_api_error(e)
 
+    @profiled("kubernetes")
     def get_secret(self, namespace, secret_name):
         api = client.CoreV1Api(self.api_client)
         return api.read_namespaced_secret(namespace=namespace, name=secret_name)
 
+    @profiled("kubernetes")
+    def list_secret(self, namespace, label_selector=""):
+        # returned as plain dicts, like the custom objects
+        api = client.CoreV1Api(self.api_client)
+        try:
+            secrets = api.list_namespaced_secret(
+                namespace=namespace, label_selector=label_selector
+            )
+        except ApiException as e:
+            print_api_error(e)
+            return {"items": []}
+        return self.api_client.sanitize_for_serialization(secrets)
+
+    @profiled("kubernetes")
     def get_config_map(self, namespace, config_map_name):
         api = client.CoreV1Api(self.api_client)
         return api.read_namespaced_config_map(namespace=namespace, name=config_map_name)
@@ -0,0 +1,349 @@
+from kubernetes_asyncio import client, config
+from kubernetes_asyncio.client.rest import ApiException
+from kubernetes_asyncio.dynamic import DynamicClient
+from kubernetes_asyncio.dynamic.exceptions import DynamicApiError, NotFoundError
+from .kubernetes import (
+    Kubernetes,
+    FIELD_MANAGER,
+    PAGE_SIZE,
+    TABLE,
+    get_pod_nodes,
+    json_loads,
+    on_unauthorized,
+    stamp_manifest_hash,
+    get_manifest_hash,
+)
+from .utils import print_api_error
+from .profiler import get_profiler, instrument_rest_client, profiled
+
+from collections import Counter
+
+import asyncio
+
+
+# asyncio counterpart of Kubernetes, all calls share one connection pool; the client owns
+# its event loop, so synchronous code drives it with run() and fans out with gather()
+class AsyncKubernetes:
+
+    def __init__(self, kubeconfig, connection_pool_maxsize=100, unauthorized=None):
+        self.loop = asyncio.new_event_loop()
+        self.api_client = self.run(
+            self.connect(kubeconfig, connection_pool_maxsize)
+        )
+        if unauthorized is not None:
+            on_unauthorized(self.api_client.rest_client, unauthorized)
+        self.dynamic_client = None
+
+    async def connect(self, kubeconfig, connection_pool_maxsize):
+        configuration = client.Configuration()
+        await config.load_kube_config_from_dict(
+            kubeconfig, client_configuration=configuration
+        )
+        configuration.connection_pool_maxsize = connection_pool_maxsize
+        api_client = client.ApiClient(configuration=configuration)
+        if get_profiler() is not None:
+            instrument_rest_client(api_client.rest_client)
+        return api_client
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    async def gather(self, coroutines, limit=None):
+        if limit is None:
+            return await asyncio.gather(*coroutines)
+        semaphore = asyncio.Semaphore(limit)
+
+        async def bounded(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*[bounded(c) for c in coroutines])
+
+    def close(self):
+        self.run(self.api_client.close())
+        self.loop.close()
+
+    # measured as the apply it makes
+    async def create(self, manifest, namespace=None):
+        applied, error = await self.apply(manifest, namespace)
+        return error
+
+    @profiled("kubernetes")
+    async def apply(self, manifest, namespace=None, current=None, lookup=True):
+        manifest, content_hash = stamp_manifest_hash(manifest)
+        if self.dynamic_client is None:
+            self.dynamic_client = await DynamicClient(self.api_client)
+        try:
+            resource = await self.dynamic_client.resources.get(
+                api_version=manifest["apiVersion"], kind=manifest["kind"]
+            )
+            if not resource.namespaced:
+                namespace = None
+            elif namespace is None:
+                namespace = manifest["metadata"].get("namespace")
+            if current is None and lookup:
+                try:
+                    current = (
+                        await self.dynamic_client.get(
+                            resource, name=manifest["metadata"]["name"], namespace=namespace
+                        )
+                    ).to_dict()
+                except NotFoundError:
+                    current = None
+            if get_manifest_hash(current) == content_hash:
+                return False, None
+            await self.dynamic_client.server_side_apply(
+                resource,
+                body=manifest,
+                namespace=namespace,
+                field_manager=FIELD_MANAGER,
+                force_conflicts=True,
+            )
+        except (ApiException, DynamicApiError) as e:
+            return False, str(e)
+        return True, None
+
+    @profiled("kubernetes")
+    async def list_cluster(self, group, version, plural, label_selector=""):
+        api = client.CustomObjectsApi(self.api_client)
+        try:
+            return await api.list_cluster_custom_object(
+                group=group,
+                version=version,
+                plural=plural,
+                label_selector=label_selector,
+            )
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            else:
+                print_api_error(e)
+
+    @profiled("kubernetes")
+    async def list(self, group, version, plural, label_selector="", namespace=None):
+        api = client.CustomObjectsApi(self.api_client)
+        if namespace is None:
+            return await api.list_custom_object_for_all_namespaces(
+                group=group,
+                version=version,
+                resource_plural=plural,
+                label_selector=label_selector,
+            )
+        else:
+            return await api.list_namespaced_custom_object(
+                group=group,
+                version=version,
+                namespace=namespace,
+                plural=plural,
+                label_selector=label_selector,
+            )
+
+    @profiled("kubernetes")
+    async def list_node(self):
+        api = client.CoreV1Api(self.api_client)
+        try:
+            return await api.list_node()
+        except ApiException as e:
+            print_api_error(e)
+
+    @profiled("kubernetes")
+    async def list_pod(self, namespace="", field_selector="", label_selector=""):
+        api = client.CoreV1Api(self.api_client)
+        try:
+            if namespace == "":
+                return await api.list_pod_for_all_namespaces(
+                    field_selector=field_selector, label_selector=label_selector
+                )
+            else:
+                return await api.list_namespaced_pod(
+                    namespace=namespace,
+                    field_selector=field_selector,
+                    label_selector=label_selector,
+                )
+        except ApiException as e:
+            print_api_error(e)
+
+    @profiled("kubernetes")
+    async def list_all_pods(self, node=None):
+        api = client.CoreV1Api(self.api_client)
+        try:
+            if node is None:
+                return await api.list_pod_for_all_namespaces()
+            else:
+                return await api.list_pod_for_all_namespaces(
+                    field_selector=f"spec.nodeName={node}"
+                )
+        except ApiException as e:
+            print_api_error(e)
+
+    @profiled("kubernetes")
+    async def list_pod_nodes(self, page_size=PAGE_SIZE):
+        # pods per node from the table columns, counted page by page; the generated
+        # api methods replace the Accept header, so the pages are requested directly
+        nodes = Counter()
+        _continue = None
+        try:
+            while True:
+                query_params = [("limit", page_size)]
+                if _continue:
+                    query_params.append(("continue", _continue))
+                response = await self.api_client.call_api(
+                    "/api/v1/pods",
+                    "GET",
+                    query_params=query_params,
+                    header_params={"Accept": TABLE},
+                    auth_settings=["BearerToken"],
+                    _preload_content=False,
+                )
+                if response.status != 200:
+                    raise ApiException(status=response.status, reason=response.reason)
+                page = json_loads(await response.read())
+                nodes.update(get_pod_nodes(page))
+                _continue = page["metadata"].get("continue")
+                if not _continue:
+                    return nodes
+        except ApiException as e:
+            print_api_error(e)
+        return nodes
+
+    @profiled("kubernetes")
+    async def get(self, group, version, plural, name, label_selector=None, namespace=None):
+        api = client.CustomObjectsApi(self.api_client)
+        try:
+            if namespace is None:
+                return await api.get_cluster_custom_object(
+                    group=group,
+                    version=version,
+                    plural=plural,
+                    name=name,
+                )
+            else:
+                return await api.get_namespaced_custom_object(
+                    group=group,
+                    version=version,
+                    namespace=namespace,
+                    plural=plural,
+                    name=name,
+                )
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            else:
+                print_api_error(e)
+
+    @profiled("kubernetes")
+    async def create_namespace(self, namespace):
+        api = client.CoreV1Api(self.api_client)
+        try:
+            await api.create_namespace(
+                body=client.V1Namespace(metadata=client.V1ObjectMeta(name=namespace))
+            )
+        except ApiException as e:
+            print_api_error(e)
+
+    @profiled("kubernetes")
+    async def create_service_account(self, namespace, name):
+        api = client.CoreV1Api(self.api_client)
+        try:
+            await api.create_namespaced_service_account(
+                namespace=namespace,
+                body=client.V1ServiceAccount(metadata=client.V1ObjectMeta(name=name)),
+            )
+        except ApiException as e:
+            print_api_error(e)
+
+    @profiled("kubernetes")
+    async def create_namespaced_cluster_role_binding(
+        self, namespace, name, cluster_role_name, service_account_name
+    ):
+        api = client.RbacAuthorizationV1Api(self.api_client)
+        try:
+            await api.create_namespaced_role_binding(
+                namespace=namespace,
+                body=client.V1RoleBinding(
+                    metadata=client.V1ObjectMeta(name=name),
+                    role_ref=client.V1RoleRef(
+                        api_group="rbac.authorization.k8s.io",
+                        kind="ClusterRole",
+                        name=cluster_role_name,
+                    ),
+                    subjects=[
+                        client.RbacV1Subject(
+                            kind="ServiceAccount",
+                            name=service_account_name,
+                            namespace=namespace,
+                        )
+                    ],
+                ),
+            )
+        except ApiException as e:
+            print_api_error(e)
+
+    @profiled("kubernetes")
+    async def get_service_account(self, namespace, service_account_name):
+        api = client.CoreV1Api(self.api_client)
+        return await api.read_namespaced_service_account(
+            namespace=namespace, name=service_account_name
+        )
+
+    @profiled("kubernetes")
+    async def create_service_account_token(
+        self, namespace, name, service_account_name, service_account_uid
+    ):
+        api = client.CoreV1Api(self.api_client)
+        try:
+            await api.create_namespaced_secret(
+                namespace=namespace,
+                body=client.V1Secret(
+                    metadata=client.V1ObjectMeta(
+                        name=name,
+                        namespace=namespace,
+                        annotations={
+                            "kubernetes.io/service-account.name": service_account_name,
+                            "kubernetes.io/service-account.uid": service_account_uid,
+                        },
+                        owner_references=[
+                            client.V1OwnerReference(
+                                api_version="v1",
+                                kind="ServiceAccount",
+                                name=service_account_name,
+                                uid=service_account_uid,
+                            )
+                        ],
+                    ),
+                    type="kubernetes.io/service-account-token",
+                ),
+            )
+        except ApiException as e:
+            print_api_error(e)
+
+    @profiled("kubernetes")
+    async def get_secret(self, namespace, secret_name):
+        api = client.CoreV1Api(self.api_client)
+        return await api.read_namespaced_secret(namespace=namespace, name=secret_name)
+
+    @profiled("kubernetes")
+    async def list_secret(self, namespace, label_selector=""):
+        api = client.CoreV1Api(self.api_client)
+        try:
+            secrets = await api.list_namespaced_secret(
+                namespace=namespace, label_selector=label_selector
+            )
+        except ApiException as e:
+            print_api_error(e)
+            return {"items": []}
+        return self.api_client.sanitize_for_serialization(secrets)
+
+    @profiled("kubernetes")
+    async def get_config_map(self, namespace, config_map_name):
+        api = client.CoreV1Api(self.api_client)
+        return await api.read_namespaced_config_map(
+            namespace=namespace, name=config_map_name
+        )
+
+    def create_kubeconfig(
+        self, namespace, cluster, context, user, token, endpoint, ca_cert
+    ):
+        return Kubernetes.create_kubeconfig(
+            self, namespace, cluster, context, user, token, endpoint, ca_cert
+        )
@@ -0,0 +1,68 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# pcidevices and pcideviceclaims of the cluster, loaded once and indexed for lookups
+class PciInventory:
+
+    def __init__(self, kubernetes):
+        self.kubernetes = kubernetes
+        # set once listed or indexed, clusters without the pcidevices addon list None
+        self.loaded = False
+        self.pcidevices_all = None
+        self.pcideviceclaims_all = None
+        self.by_address = {}
+        self.by_name = {}
+        self.by_node = {}
+        self.claims = set()
+
+    def load(self):
+        # these are expensive call so load them once and then itterate and filter in code
+        self.pcidevices_all = self.kubernetes.list_cluster(
+            "devices.harvesterhci.io",
+            "v1beta1",
+            "pcidevices",
+        )
+        self.pcideviceclaims_all = self.kubernetes.list_cluster(
+            "devices.harvesterhci.io",
+            "v1beta1",
+            "pcideviceclaims",
+        )
+        self.index(self.pcidevices_all, self.pcideviceclaims_all)
+
+    def index(self, pcidevices_all, pcideviceclaims_all):
+        self.loaded = True
+        self.pcidevices_all = pcidevices_all
+        self.pcideviceclaims_all = pcideviceclaims_all
+        self.by_address = {}
+        self.by_name = {}
+        self.by_node = {}
+        self.claims = set()
+        if self.pcideviceclaims_all is not None:
+            for claim in self.pcideviceclaims_all["items"]:
+                self.claims.add((claim["spec"]["nodeName"], claim["metadata"]["name"]))
+        if self.pcidevices_all is None:
+            return
+        for device in self.pcidevices_all["items"]:
+            node = device["metadata"]["labels"]["nodename"]
+            self.by_name[device["metadata"]["name"]] = device
+            self.by_node.setdefault(node, []).append(device)
+            if "address" in device["status"]:
+                self.by_address[(node, device["status"]["address"])] = device
+        logger.debug(f"Loaded {len(self.by_name)} pcidevices")
+
+    def find_by_address(self, node, address):
+        device = self.by_address.get((node, address))
+        if device is None:
+            return None
+        return {
+            "name": device["metadata"]["name"],
+            "deviceName": device["status"]["resourceName"],
+        }
+
+    def find_by_node(self, node):
+        return self.by_node.get(node, [])
+
+    def is_claimed(self, node, name):
+        return (node, name) in self.claims
@@ -0,0 +1,112 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# free capacity of one node while vms are being placed on it
+class NodeCapacity:
+    __slots__ = ["name", "cpu", "memory", "vm", "cpu_available", "memory_available", "pcidevices"]
+
+    def __init__(self, name, node_data):
+        resources = node_data["resources"]
+        self.name = name
+        self.cpu = resources["cpu"]["free"]
+        self.memory = resources["memory"]["free"]
+        self.vm = resources["vm"]["free"]
+        self.cpu_available = max(resources["cpu"]["available"], 1)
+        self.memory_available = max(resources["memory"]["available"], 1)
+        # free passthrough devices by pci address
+        self.pcidevices = {}
+        for pcidevice in node_data["pcidevices"]:
+            if pcidevice["usedBy"] == "":
+                self.pcidevices[pcidevice["address"]] = pcidevice
+
+    def fits(self, cpu, memory, addresses):
+        if self.vm < 1 or self.cpu < cpu or self.memory < memory:
+            return False
+        for address in addresses:
+            if address not in self.pcidevices:
+                return False
+        return True
+
+    def take(self, cpu, memory, addresses):
+        self.vm -= 1
+        self.cpu -= cpu
+        self.memory -= memory
+        for address in addresses:
+            del self.pcidevices[address]
+
+    def score(self, cpu, memory):
+        # best fit: the node with the least capacity left over after placing the vm
+        return (self.cpu - cpu) / self.cpu_available + (
+            self.memory - memory
+        ) / self.memory_available
+
+
+class Placement:
+    def __init__(self, config, resources_data):
+        self.config = config
+        self.nodes = {}
+        self.running = {}
+        for name, node_data in sorted(resources_data["nodes"].items()):
+            self.nodes[name] = NodeCapacity(name, node_data)
+            for vm_name in node_data["vms"]:
+                self.running[vm_name] = name
+
+    def get_addresses(self, vm):
+        addresses = []
+        for wanted_pcidevice in vm.get("pcidevices", []):
+            pcidevice = self.config["machines"]["pcidevices"].get(wanted_pcidevice, {})
+            addresses.extend(pcidevice.get("address", []))
+        return addresses
+
+    def get_requirements(self, vm):
+        return int(vm["cpu"]), int(vm["memory"]), self.get_addresses(vm)
+
+    def place(self, vms):
+        # running vms stay where they are and are already counted as used,
+        # pinned vms take their capacity first, the rest is placed biggest first
+        unplaced = []
+        pending = []
+        for vm in vms:
+            if vm["name"] in self.running:
+                if vm.get("harvester_node", "") == "":
+                    vm["harvester_node"] = self.running[vm["name"]]
+            elif vm.get("harvester_node", "") != "":
+                node = self.nodes.get(vm["harvester_node"])
+                if node is not None:
+                    cpu, memory, addresses = self.get_requirements(vm)
+                    node.take(
+                        cpu,
+                        memory,
+                        [address for address in addresses if address in node.pcidevices],
+                    )
+            else:
+                pending.append(vm)
+
+        pending.sort(
+            key=lambda vm: (
+                len(self.get_addresses(vm)),
+                int(vm["cpu"]),
+                int(vm["memory"]),
+            ),
+            reverse=True,
+        )
+        for vm in pending:
+            cpu, memory, addresses = self.get_requirements(vm)
+            best = None
+            best_score = None
+            for node in self.nodes.values():
+                if node.fits(cpu, memory, addresses):
+                    score = node.score(cpu, memory)
+                    if best is None or score < best_score:
+                        best = node
+                        best_score = score
+            if best is None:
+                logger.error(f"No node with enough free resources for VM {vm['name']}")
+                unplaced.append(vm["name"])
+                continue
+            best.take(cpu, memory, addresses)
+            vm["harvester_node"] = best.name
+            logger.info(f"Placed VM {vm['name']} on node {best.name}")
+        return unplaced
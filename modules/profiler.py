@@ -0,0 +1,235 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# the active profiler, None when profiling is off so instrumented calls cost a single check
+_profiler = None
+# phase and innermost measured call of the current thread or asyncio task
+_phase = ContextVar("phase", default=("", ""))
+_event = ContextVar("event", default=None)
+
+
+class Event:
+    __slots__ = ["kind", "name", "phase", "label", "thread", "start", "duration", "size", "requests"]
+
+    def __init__(self, kind, name, phase, label, start):
+        self.kind = kind
+        self.name = name
+        self.phase = phase
+        self.label = label
+        self.thread = threading.get_ident()
+        self.start = start
+        self.duration = 0.0
+        self.size = 0
+        self.requests = 0
+
+
+class Profiler:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def get_summary(self):
+        # calls of the same kind and name within a phase, all vms share the vm phase
+        rows = {}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            if event.kind == "phase":
+                continue
+            key = (event.phase, event.kind, event.name)
+            row = rows.setdefault(
+                key, {"count": 0, "total": 0.0, "max": 0.0, "size": 0, "requests": 0}
+            )
+            row["count"] += 1
+            row["total"] += event.duration
+            row["max"] = max(row["max"], event.duration)
+            row["size"] += event.size
+            row["requests"] += event.requests
+        return dict(sorted(rows.items(), key=lambda item: item[1]["total"], reverse=True))
+
+    def print_summary(self, file=sys.stderr):
+        phases = {}
+        for event in self.events:
+            if event.kind == "phase":
+                phases[event.phase] = phases.get(event.phase, 0.0) + event.duration
+        print(f"{'PHASE': <16}{'TIME (s)': >10}", file=file)
+        for name, duration in sorted(phases.items(), key=lambda item: item[1], reverse=True):
+            print(f"{name: <16}{duration: >10.3f}", file=file)
+        print(file=file)
+        print(
+            f"{'PHASE': <16}{'KIND': <12}{'CALL': <44}{'COUNT': >7}{'TOTAL (s)': >11}"
+            f"{'AVG (ms)': >10}{'MAX (ms)': >10}{'BYTES': >12}",
+            file=file,
+        )
+        for (phase, kind, name), row in self.get_summary().items():
+            average = row["total"] / row["count"] * 1000
+            print(
+                f"{phase or '-': <16}{kind: <12}{name[:43]: <44}{row['count']: >7}"
+                f"{row['total']: >11.3f}{average: >10.1f}{row['max'] * 1000: >10.1f}"
+                f"{row['size']: >12}",
+                file=file,
+            )
+
+    def get_trace(self):
+        # chrome trace event format, complete events in microseconds
+        trace_events = []
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            trace_events.append(
+                {
+                    "name": event.label if event.kind == "phase" else event.name,
+                    "cat": event.kind,
+                    "ph": "X",
+                    "ts": round((event.start - self.origin) * 1000000, 1),
+                    "dur": round(event.duration * 1000000, 1),
+                    "pid": pid,
+                    "tid": event.thread,
+                    "args": {
+                        "phase": event.label,
+                        "bytes": event.size,
+                        "requests": event.requests,
+                    },
+                }
+            )
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def write_trace(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.get_trace(), f)
+
+
+def enable():
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+@contextmanager
+def phase(name, label=None):
+    if _profiler is None:
+        yield
+        return
+    label = name if label is None else f"{name} {label}"
+    token = _phase.set((name, label))
+    event = Event("phase", name, name, label, time.perf_counter())
+    try:
+        yield
+    finally:
+        _phase.reset(token)
+        event.duration = time.perf_counter() - event.start
+        _profiler.add(event)
+
+
+@contextmanager
+def measure(kind, name):
+    if _profiler is None:
+        yield None
+        return
+    phase_name, label = _phase.get()
+    event = Event(kind, name, phase_name, label, time.perf_counter())
+    token = _event.set(event)
+    try:
+        yield event
+    finally:
+        _event.reset(token)
+        event.duration = time.perf_counter() - event.start
+        _profiler.add(event)
+
+
+def profiled(kind):
+    def decorator(function):
+        name = function.__qualname__
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if _profiler is None:
+                    return await function(*args, **kwargs)
+                with measure(kind, name):
+                    return await function(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return function(*args, **kwargs)
+            with measure(kind, name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add_payload(size):
+    # bytes of one request made inside a measured call
+    event = _event.get()
+    if event is not None:
+        event.size += size
+        event.requests += 1
+
+
+def get_size(data):
+    if data is None:
+        return 0
+    if isinstance(data, (bytes, str)):
+        return len(data)
+    return len(json.dumps(data, default=str))
+
+
+def instrument_rest_client(rest_client):
+    # count request and response bytes of the kubernetes client, watch streams are
+    # read incrementally by their consumer and only count the request
+    request = rest_client.request
+
+    if inspect.iscoroutinefunction(request):
+
+        async def async_profiled_request(method, url, *args, **kwargs):
+            response = await request(method, url, *args, **kwargs)
+            add_payload(get_size(kwargs.get("body")) + get_size(getattr(response, "data", None)))
+            return response
+
+        rest_client.request = async_profiled_request
+        return
+
+    def profiled_request(method, url, *args, **kwargs):
+        response = request(method, url, *args, **kwargs)
+        size = get_size(kwargs.get("body"))
+        if "watch=true" not in url.lower():
+            size += get_size(response.read())
+        add_payload(size)
+        return response
+
+    rest_client.request = profiled_request
+
+
+def report(filename):
+    # summary on stderr and the chrome trace in filename, at the end of a profiled run
+    if _profiler is None:
+        return
+    _profiler.print_summary()
+    _profiler.write_trace(filename)
+    print(f"Chrome trace written to {filename}", file=sys.stderr)
@@ -3,8 +3,12 @@ from .templates import Template
 from .api import Api
 from .kubernetes import Kubernetes
 from .utils import merge_dict
-from time import sleep
+from .cache import Cache
+from .executor import StepError
+from time import sleep, time
+from datetime import datetime
 
+import hashlib
 import yaml
 import logging
 
@@ -14,20 +18,92 @@ logger = logging.getLogger(__name__)
 class Rancher:
     def __init__(self, config):
         self.config = config
-        self.api = Api(self.config["rancher"]["hostname"], self.config["api_token"])
+        self.api = Api(
+            self.config["rancher"]["hostname"],
+            self.config["api_token"],
+            timeout=self.config["rancher"].get("timeout", 30),
+            retries=self.config["rancher"].get("retries", 3),
+        )
+        self.cache = Cache(self.config["rancher"].get("cache_directory"))
+        self.cache_ttl = self.config["rancher"].get("cache_ttl", 3600)
+        # entries of another token (rotated, or another user sharing the cache directory)
+        # are never used
+        self.token_hash = hashlib.sha256(
+            self.config["api_token"].encode("utf-8")
+        ).hexdigest()[:16]
+        self.local_kubernetes = None
 
     def get_cluster_id(self, cluster_name):
-        data = self.api.get(f"/v3/clusters?name={cluster_name}")
-        return data["data"][0]["id"]
+        key = f"cluster-id/{self.config['rancher']['hostname']}/{self.token_hash}/{cluster_name}"
+        cluster_id = self.cache.get(key)
+        if cluster_id is None:
+            data = self.api.get(f"/v3/clusters?name={cluster_name}")
+            cluster_id = data["data"][0]["id"]
+            self.cache.set(key, cluster_id, self.cache_ttl)
+        return cluster_id
+
+    def get_harvester_clusters(self):
+        data = self.api.get("/v3/clusters")
+        clusters = []
+        for cluster in data["data"]:
+            if cluster.get("labels", {}).get("provider.cattle.io") == "harvester":
+                clusters.append(cluster["name"])
+        return sorted(clusters)
+
+    def get_kubeconfig_key(self, cluster_id):
+        return f"kubeconfig/{self.config['rancher']['hostname']}/{self.token_hash}/{cluster_id}"
 
     def get_kubeconfig(self, cluster_name):
         cluster_id = self.get_cluster_id(cluster_name)
+        key = self.get_kubeconfig_key(cluster_id)
+        kubeconfig = self.cache.get(key)
+        if kubeconfig is not None:
+            return kubeconfig
         data = self.api.post(f"/v3/clusters/{cluster_id}?action=generateKubeconfig")
         if "config" in data:
-            return yaml.safe_load(data["config"])
+            kubeconfig = yaml.safe_load(data["config"])
+            self.cache.set(key, kubeconfig, self.get_kubeconfig_ttl(kubeconfig))
+            return kubeconfig
         else:
             return {}
 
+    def invalidate_kubeconfig(self, cluster_name):
+        # the next get_kubeconfig generates a new one
+        logger.warning(f"Kubeconfig of cluster {cluster_name} was rejected, removed from the cache")
+        cluster_id = self.get_cluster_id(cluster_name)
+        self.cache.invalidate(self.get_kubeconfig_key(cluster_id))
+
+    def get_kubeconfig_ttl(self, kubeconfig):
+        # never cache a kubeconfig beyond the expiry of its rancher token
+        ttl = self.cache_ttl
+        try:
+            token_name = kubeconfig["users"][0]["user"]["token"].split(":")[0]
+            token = self.api.get(f"/v3/tokens/{token_name}")
+            if token.get("expired", False):
+                return 0
+            if token.get("expiresAt", "") != "":
+                expires_at = datetime.fromisoformat(token["expiresAt"].replace("Z", "+00:00"))
+                token_ttl = expires_at.timestamp() - datetime.now().timestamp() - 60
+                ttl = max(min(ttl, token_ttl), 0)
+        except (KeyError, IndexError, ValueError) as e:
+            logger.debug(f"Unable to determine kubeconfig token expiry: {e}")
+        return ttl
+
+    def get_api_counters(self):
+        return self.api.get_counters()
+
+    def close(self):
+        self.api.close()
+
+    def get_local_kubernetes(self):
+        if self.local_kubernetes is None:
+            cluster_name = self.config["rancher"]["cluster_name"]
+            self.local_kubernetes = Kubernetes(
+                self.get_kubeconfig(cluster_name),
+                unauthorized=lambda: self.invalidate_kubeconfig(cluster_name),
+            )
+        return self.local_kubernetes
+
     def get_rke2_node_command(self, cluster_name):
         cluster_id = self.get_cluster_id(cluster_name)
         data = self.api.get(f"/v3/clusters/{cluster_id}/clusterregistrationtokens")
@@ -35,8 +111,7 @@ class Rancher:
         return data["data"][0]["nodeCommand"]
 
     def get_cluster(self, cluster_name):
-        kubeconfig = self.get_kubeconfig(self.config["rancher"]["cluster_name"])
-        kubernetes = Kubernetes(kubeconfig)
+        kubernetes = self.get_local_kubernetes()
         return kubernetes.get(
             group="provisioning.cattle.io",
             version="v1",
@@ -45,25 +120,60 @@ class Rancher:
             namespace="fleet-default",
         )
 
-    def wait_for_cluster(self, blueprint):
-        while True:
-            cluster = self.get_cluster(blueprint["cluster"]["name"])
-            if cluster is not None:
-                for condition in cluster["status"]["conditions"]:
-                    if condition["type"] == "Ready":
-                        if condition["status"] == "True":
-                            return
-                        else:
-                            if condition["reason"] == "Waiting":
-                                return
-            sleep(1)
+    def is_cluster_ready(self, cluster):
+        for condition in cluster.get("status", {}).get("conditions", []):
+            if condition["type"] == "Ready":
+                if condition["status"] == "True":
+                    return True
+                else:
+                    if condition.get("reason") == "Waiting":
+                        return True
+        return False
+
+    def wait_for_cluster(self, blueprint, timeout=None):
+        cluster_name = blueprint["cluster"]["name"]
+        if timeout is None:
+            timeout = self.config["rancher"].get("cluster_timeout", 1800)
+        deadline = time() + timeout
+        backoff = 1
+        progress = None
+        kubernetes = self.get_local_kubernetes()
+        while time() < deadline:
+            try:
+                for event_type, cluster in kubernetes.watch(
+                    group="provisioning.cattle.io",
+                    version="v1",
+                    plural="clusters",
+                    name=cluster_name,
+                    namespace="fleet-default",
+                    timeout_seconds=max(int(min(deadline - time(), 300)), 1),
+                ):
+                    backoff = 1
+                    if event_type == "DELETED":
+                        continue
+                    for condition in cluster.get("status", {}).get("conditions", []):
+                        if condition["type"] == "Ready":
+                            status = (condition["status"], condition.get("reason", ""), condition.get("message", ""))
+                            if status != progress:
+                                progress = status
+                                logger.info(f"Cluster {cluster_name}: Ready={status[0]} {status[1]} {status[2]}".strip())
+                    if self.is_cluster_ready(cluster):
+                        return True
+            except Exception as e:
+                logger.warning(f"Watch on cluster {cluster_name} failed, retrying in {backoff}s: {e}")
+                sleep(min(backoff, max(deadline - time(), 0)))
+                backoff = min(backoff * 2, 30)
+        logger.error(f"Timeout after {timeout}s waiting for cluster {cluster_name}")
+        return False
 
     def create_cluster(self, blueprint):
         logging.info(f"Create cluster {blueprint['cluster']['name']}")
-        kubeconfig = self.get_kubeconfig(self.config["rancher"]["cluster_name"])
         template = Template("cluster")
         cluster_manifest = template.parse(blueprint=merge_dict(self.config, blueprint))
-        kubernetes = Kubernetes(kubeconfig)
-        result = kubernetes.create(cluster_manifest, "fleet-default")
-        self.wait_for_cluster(blueprint)
-        return result
+        kubernetes = self.get_local_kubernetes()
+        # raised, so the provisioning steps that need the cluster are skipped
+        error = kubernetes.create(cluster_manifest, "fleet-default")
+        if error:
+            raise StepError(f"Failed to create cluster {blueprint['cluster']['name']}: {error}")
+        if not self.wait_for_cluster(blueprint):
+            raise StepError(f"Cluster {blueprint['cluster']['name']} is not ready")
@@ -0,0 +1,101 @@
+from .templates import Template, set_bytecode_cache
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# config of a render worker process, sent once per process instead of with every vm
+_config = None
+
+
+def render_vm_manifest(config, vm, pcidevices, disks):
+    template = Template("virtualmachine")
+    vm_manifest = template.parse(
+        blueprint=config,
+        vm=vm,
+        pcidevices=pcidevices,
+        disks=disks,
+    )
+
+    logger.debug(vm_manifest)
+    return vm_manifest
+
+
+def render_cloudinit_secret(config, vm, node_command, csi_cloudconfig):
+    role = ""
+    if "role" in vm:
+        for r in vm["role"]:
+            role = f"{role} --{r}".strip()
+
+    template = Template("user-data")
+    cloudinit_user_data = template.parse(
+        blueprint=config,
+        vm=vm,
+        csi_cloudconfig=csi_cloudconfig,
+        node_command=node_command,
+        role=role,
+    )
+
+    template = Template("network-data")
+    cloudinit_network_data = template.parse(
+        blueprint=config,
+        vm=vm,
+    )
+
+    template = Template("cloudinit-secret")
+    return template.parse(
+        blueprint=config,
+        vm=vm,
+        cloudinit_user_data=cloudinit_user_data,
+        cloudinit_network_data=cloudinit_network_data,
+    )
+
+
+def init_worker(config, template_cache):
+    global _config
+    _config = config
+    if template_cache:
+        set_bytecode_cache(template_cache)
+
+
+def render_vm(task, config=None):
+    if config is None:
+        config = _config
+    vm, pcidevices, disks, node_command, csi_cloudconfig = task
+    return (
+        vm["name"],
+        render_cloudinit_secret(config, vm, node_command, csi_cloudconfig),
+        render_vm_manifest(config, vm, pcidevices, disks),
+    )
+
+
+def render_vms(config, tasks, processes=None, template_cache=None):
+    # rendering is cpu bound, so it is spread over processes; tasks are sent in
+    # chunks to keep the pickling overhead per vm low
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(min(int(processes), len(tasks)), 1)
+    if processes == 1:
+        return [render_vm(task, config) for task in tasks]
+    chunksize = max(len(tasks) // (processes * 4), 1)
+    logger.info(f"Render {len(tasks)} VMs in {processes} processes")
+    with ProcessPoolExecutor(
+        max_workers=processes, initializer=init_worker, initargs=(config, template_cache)
+    ) as executor:
+        return list(executor.map(render_vm, tasks, chunksize=chunksize))
+
+
+def write_manifests(manifests, output):
+    # one file per manifest in the output directory, or one multi-document stream on stdout
+    if output == "-":
+        for filename, manifest in manifests:
+            print("---")
+            print(manifest.strip())
+        return
+    os.makedirs(output, exist_ok=True)
+    for filename, manifest in manifests:
+        with open(os.path.join(output, filename), "w") as f:
+            f.write(manifest.strip() + "\n")
+    logger.info(f"{len(manifests)} manifests written to {output}")
@@ -1,54 +1,100 @@
 from .utils import get_value, format_k8s_value
+from .pcidevices import PciInventory
 
-# import yaml
+from array import array
+
+import asyncio
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+AVAILABLE = 0
+USED = 1
+
+
+# resource counters of all nodes in two flat arrays, one fixed slot per resource per node
+class ResourceLedger:
+    __slots__ = ["fields", "index", "nodes", "values"]
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.index = {field: i for i, field in enumerate(fields)}
+        self.nodes = []
+        self.values = (array("q"), array("q"))
+
+    def add_node(self, name):
+        row = len(self.nodes) * len(self.fields)
+        self.nodes.append(name)
+        for values in self.values:
+            values.extend([0] * len(self.fields))
+        return row
+
+    def add(self, row, kind, values):
+        counters = self.values[kind]
+        for key, value in values.items():
+            counters[row + self.index[key]] += value
+
+    def to_dict(self, available, used):
+        resources = {}
+        for i, field in enumerate(self.fields):
+            resources[field] = {
+                "available": available[i],
+                "used": used[i],
+                "free": available[i] - used[i],
+            }
+        return resources
+
+    def get_node(self, row):
+        width = len(self.fields)
+        return self.to_dict(
+            self.values[AVAILABLE][row : row + width],
+            self.values[USED][row : row + width],
+        )
+
+    def get_totals(self):
+        # strided slices pick one resource over all nodes
+        width = len(self.fields)
+        totals = [[sum(values[i::width]) for i in range(width)] for values in self.values]
+        return self.to_dict(totals[AVAILABLE], totals[USED])
+
+
 class Resources:
 
-    def __init__(self, config, kubernetes):
+    def __init__(self, config, kubernetes, async_kubernetes=None, pci_inventory=None):
         self.config = config
         self.kubernetes = kubernetes
-        # these are expensive call so load them once and then itterate and filter in code
-        self.available_pcidevices_all = self.kubernetes.list_cluster(
-        "devices.harvesterhci.io",
-        "v1beta1",
-        "pcidevices",
-        )
-        self.pcideviceclaims_all = self.kubernetes.list_cluster(
-        "devices.harvesterhci.io",
-        "v1beta1",
-        "pcideviceclaims",
-        )
+        self.async_kubernetes = async_kubernetes
+        if pci_inventory is None:
+            pci_inventory = PciInventory(self.kubernetes)
+            pci_inventory.load()
+        self.pci_inventory = pci_inventory
+        # reverse map of resource_definitions: resourceName -> resource class
+        self.resource_classes = {}
+        for resource_class in self.config["resource_definitions"]:
+            for resource_name in self.config["resource_definitions"][resource_class]:
+                self.resource_classes.setdefault(resource_name, resource_class)
 
     def get_available_pcidevices(self, node):
         result = []
-        if self.available_pcidevices_all is None:
+        if self.pci_inventory.pcidevices_all is None:
             return result
-        for device in self.available_pcidevices_all["items"]:
-            if device["metadata"]["labels"]["nodename"] == node:
-                for resource_class in self.config["resource_definitions"]:
-                    for resource_name in self.config["resource_definitions"][resource_class]:
-                        if resource_name == device["status"]["resourceName"]:
-                            if self.is_pcidevice_available(node, device["metadata"]["name"]):
-                                result.append(
-                                {
-                                    "name": device["metadata"]["name"],
-                                    "address": device["status"]["address"],
-                                    "deviceName": device["status"]["resourceName"],
-                                    "usedBy": ""
-                                })
+        for device in self.pci_inventory.find_by_node(node):
+            if device["status"]["resourceName"] in self.resource_classes:
+                if self.is_pcidevice_available(node, device["metadata"]["name"]):
+                    result.append(
+                    {
+                        "name": device["metadata"]["name"],
+                        "address": device["status"]["address"],
+                        "deviceName": device["status"]["resourceName"],
+                        "usedBy": ""
+                    })
         return result
 
     def is_pcidevice_available(self,node, name):
-        for device in self.pcideviceclaims_all["items"]:
-            if device["spec"]["nodeName"] == node and device["metadata"]["name"] == name:
-                return True
-        return False
+        return self.pci_inventory.is_claimed(node, name)
 
-    def get_node_resources(self, node, status_data, values):
+    def get_node_resources(self, node, status_data, values, pod_count):
         data = {
             "capacity": {},
             "allocatable": {},
@@ -61,7 +107,7 @@ class Resources:
                 value, get_value(status_data.allocatable, value)
             )
         data["capacity"]["vm"]= int(status_data.capacity["pods"])
-        data["allocatable"]["vm"] = int(status_data.capacity["pods"]) - self.get_pod_count(node)
+        data["allocatable"]["vm"] = int(status_data.capacity["pods"]) - pod_count
         return data
 
     def get_virtualmachine_instances(self, node=None):
@@ -75,120 +121,105 @@ class Resources:
             label_selector
         )
 
-    def count_pcidevices(self, used_pcidevices_total, pcidevices):
-        used_pcidevices={}
+    def count_pcidevices(self, pcidevices):
+        used_pcidevices = {}
         for resource_class in self.config["resource_definitions"]:
-            if resource_class not in used_pcidevices_total:
-                used_pcidevices_total[resource_class] = 0;
-            if resource_class not in used_pcidevices:
-                used_pcidevices[resource_class] = 0
-            for pcidevice in pcidevices:
-                if pcidevice["deviceName"] in self.config["resource_definitions"][resource_class]:
-                    used_pcidevices_total[resource_class] += 1
-                    used_pcidevices[resource_class] += 1
-        return used_pcidevices_total, used_pcidevices
-
-    def get_virtualmachine_resources_by_node(self, node,pcidevices_all):
+            used_pcidevices[resource_class] = 0
+        for pcidevice in pcidevices:
+            resource_class = self.resource_classes.get(pcidevice["deviceName"])
+            if resource_class is not None:
+                used_pcidevices[resource_class] += 1
+        return used_pcidevices
+
+    def get_virtualmachine_resources_by_node(self, node,pcidevices_all, instances=None):
         vms = {}
-        used_pcidevices_total = {}
-        used_resources_total = {}
-        instances = self.get_virtualmachine_instances(node)
+        used_resources = self.count_pcidevices([])
+        used_resources["cpu"] = 0
+        used_resources["memory"] = 0
+        if instances is None:
+            instances = self.get_virtualmachine_instances(node)
+        pcidevices_by_name = {pcidevice["name"]: pcidevice for pcidevice in pcidevices_all}
         for instance in instances["items"]:
+            cpu = format_k8s_value("cpu", instance["spec"]["domain"]["cpu"]["cores"])
+            memory = format_k8s_value("memory",instance["spec"]["domain"]["memory"]["guest"])
+            vms[instance["metadata"]["name"]] = {
+                "cpu": cpu,
+                "memory": memory,
+                "pcidevices": [],
+            }
+            used_resources["cpu"] += cpu
+            used_resources["memory"] += memory
             if "hostDevices" in instance["spec"]["domain"]["devices"]:
-                used_pcidevices_total, used_pcidevices = self.count_pcidevices(used_pcidevices_total, instance["spec"]["domain"]["devices"]["hostDevices"])
                 pcidevices = instance["spec"]["domain"]["devices"]["hostDevices"]
                 for pcidevice in pcidevices:
-                    for i, pcidevice_all in enumerate(pcidevices_all):
-                        if pcidevice["name"] == pcidevice_all["name"]:
-                            pcidevices_all[i]["usedBy"] = instance["metadata"]["name"]
-            else:
-                pcidevices = []
-                used_pcidevices = {}
-            vms[instance["metadata"]["name"]] = {
-                "cpu": format_k8s_value("cpu", instance["spec"]["domain"]["cpu"]["cores"]),
-                "memory": format_k8s_value("memory",instance["spec"]["domain"]["memory"]["guest"]),
-                "pcidevices": pcidevices
-            }
-            used_resources_total = self.add_totals(
-                used_resources_total, {
-                "cpu": format_k8s_value("cpu", instance["spec"]["domain"]["cpu"]["cores"]),
-                "memory": format_k8s_value("memory",instance["spec"]["domain"]["memory"]["guest"])})
-            for used_pcidevice in used_pcidevices:
-                vms[instance["metadata"]["name"]][used_pcidevice] = used_pcidevices[used_pcidevice]
-
-        used_resources_total["vm"] = len(vms)
-
-        return used_resources_total, used_pcidevices_total, pcidevices_all, vms
-
-    def add_totals(self, total_values, values):
-        if total_values == {}:
-            for key in values:
-                total_values[key] = values[key]
-        else:
-            for key in total_values:
-                if key in values:
-                    total_values[key] += values[key]
-        return total_values
-
-    def define_resources_dict(self):
-        resources = {"vm": {}, "cpu": {}, "memory": {}}
-        for field in self.config["resource_definitions"]:
-            resources[field]={}
-        for key in resources:
-            resources[key] = {
-                "available": 0,
-                "used": 0,
-                "free": 0
-            }
-        return resources
+                    if pcidevice["name"] in pcidevices_by_name:
+                        pcidevices_by_name[pcidevice["name"]]["usedBy"] = instance["metadata"]["name"]
+                vms[instance["metadata"]["name"]]["pcidevices"] = pcidevices
+                for resource_class, count in self.count_pcidevices(pcidevices).items():
+                    vms[instance["metadata"]["name"]][resource_class] = count
+                    used_resources[resource_class] += count
 
-    def add_to_resources(self, resources, resources_type, values):
-        for key in values:
-            resources[key][resources_type] = values[key]
-        return resources
+        used_resources["vm"] = len(vms)
 
-    def update_free_resources(self, resources):
-        for key in resources:
-            resources[key]["free"] = resources[key]["available"] - resources[key]["used"]
-        return resources
+        return used_resources, pcidevices_all, vms
 
-    def get_pod_count(self, node = None):
-        pods = self.kubernetes.list_all_pods(node)
-        return len(pods.items)
+    def get_resource_fields(self):
+        return ["vm", "cpu", "memory"] + list(self.config["resource_definitions"])
 
-    # TODO: This code needs some serious refactoring, create class for resource_dict
-    def get(self):
+    def group_by_node(self, instances, pod_counts):
+        # list once cluster wide and group in memory instead of calling the api per node
+        nodes_data = {}
+        for instance in instances["items"]:
+            node = instance["metadata"].get("labels", {}).get("kubevirt.io/nodeName")
+            nodes_data.setdefault(node, self.empty_node_data())["instances"]["items"].append(instance)
+        for node, count in pod_counts.items():
+            nodes_data.setdefault(node, self.empty_node_data())["pod_count"] += count
+        return nodes_data
+
+    def empty_node_data(self):
+        return {"instances": {"items": []}, "pod_count": 0}
+
+    def get_nodes_data(self):
+        return self.group_by_node(
+            self.get_virtualmachine_instances(),
+            self.kubernetes.list_pod_nodes(),
+        )
+
+    async def get_nodes_data_async(self):
+        instances, pod_counts = await asyncio.gather(
+            self.async_kubernetes.list(
+                "kubevirt.io",
+                "v1",
+                "virtualmachineinstances",
+            ),
+            self.async_kubernetes.list_pod_nodes(),
+        )
+        return self.group_by_node(instances, pod_counts)
+
+    def get(self, nodes=None, nodes_data=None):
         data = {"nodes":{}}
-        nodes = self.kubernetes.list_node()
-        available_pcidevices_total = {}
-        used_pcidevices_total = {}
-        used_resources_total = {}
-        available_resources_total = {}
-        for node in nodes.items:
+        if nodes is None:
+            nodes = self.kubernetes.list_node(raw=True).items
+        if nodes_data is None:
+            if self.async_kubernetes is not None:
+                nodes_data = self.async_kubernetes.run(self.get_nodes_data_async())
+            else:
+                nodes_data = self.get_nodes_data()
+        ledger = ResourceLedger(self.get_resource_fields())
+        for node in nodes:
             logging.info(f"Getting data for node: {node.metadata.name}")
-            resources = self.define_resources_dict()
+            node_data = nodes_data.get(node.metadata.name, self.empty_node_data())
+            row = ledger.add_node(node.metadata.name)
             pcidevices = self.get_available_pcidevices(node.metadata.name)
-            available_pcidevices_total, available_pcidevices = self.count_pcidevices(available_pcidevices_total, pcidevices)
-            used_resources, used_pcidevices, pcidevices, vms = self.get_virtualmachine_resources_by_node(node.metadata.name, pcidevices)
-            used_pcidevices_total = self.add_totals(used_pcidevices_total, used_pcidevices)
-            used_resources_total =  self.add_totals(used_resources_total, used_resources)
-            available_resources = self.get_node_resources(node.metadata.name, node.status, ["cpu", "memory"])
-            available_resources_total = self.add_totals(available_resources_total, available_resources["allocatable"])
-            resources = self.add_to_resources(resources, "available", available_pcidevices)
-            resources = self.add_to_resources(resources, "used", used_pcidevices)
-            resources = self.add_to_resources(resources, "available", available_resources["allocatable"])
-            resources = self.add_to_resources(resources, "used", used_resources)
-            resources = self.update_free_resources(resources)
+            ledger.add(row, AVAILABLE, self.count_pcidevices(pcidevices))
+            used_resources, pcidevices, vms = self.get_virtualmachine_resources_by_node(node.metadata.name, pcidevices, node_data["instances"])
+            ledger.add(row, USED, used_resources)
+            available_resources = self.get_node_resources(node.metadata.name, node.status, ["cpu", "memory"], node_data["pod_count"])
+            ledger.add(row, AVAILABLE, available_resources["allocatable"])
             data["nodes"][node.metadata.name] = {
                 "vms": vms,
                 "pcidevices": pcidevices,
-                "resources": resources
+                "resources": ledger.get_node(row)
             }
-        totals = self.define_resources_dict()
-        totals = self.add_to_resources(totals, "available", available_pcidevices_total)
-        totals = self.add_to_resources(totals, "available", available_resources_total)
-        totals = self.add_to_resources(totals, "used", used_resources_total)
-        totals = self.add_to_resources(totals, "used", used_pcidevices_total)
-        totals = self.update_free_resources(totals)
-        data["totals"] = totals
+        data["totals"] = ledger.get_totals()
         return data
@@ -0,0 +1,59 @@
+import json
+import os
+import hashlib
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(*inputs):
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+# fingerprints of what was applied per vm of a blueprint, kept on disk between runs
+# so a run only renders and applies the vms whose inputs changed
+class State:
+    def __init__(self, directory, name):
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.filename = os.path.join(directory, f"{name}.json")
+        self.lock = threading.Lock()
+        self.vms = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                self.vms = json.load(f).get("vms", {})
+        except FileNotFoundError:
+            self.vms = {}
+        except (OSError, ValueError) as e:
+            # a broken state only costs a full run
+            logger.warning(f"Ignoring state {self.filename}: {e}")
+            self.vms = {}
+
+    def get(self, name):
+        with self.lock:
+            return self.vms.get(name, {})
+
+    def set(self, name, entry):
+        with self.lock:
+            self.vms[name] = entry
+
+    def prune(self, names):
+        # forget vms that are no longer in the blueprint
+        with self.lock:
+            self.vms = {name: entry for name, entry in self.vms.items() if name in names}
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({"vms": self.vms}, sort_keys=True, indent=2)
+        # written next to the old state and renamed, an interrupted run keeps the old one
+        temporary = f"{self.filename}.tmp"
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(temporary, self.filename)
+        logger.debug(f"State of {len(self.vms)} VMs written to {self.filename}")
@@ -1,20 +1,71 @@
 import jinja2
 from .filters import to_yaml, to_json, b64encode
+from .profiler import measure
+import hashlib
+import os
+import threading
 import logging
 
 logger = logging.getLogger(__name__)
 
+TEMPLATE_DIRECTORY = "./templates"
+
+# one environment per process, templates are compiled once and reused by every render
+_environment = None
+_environment_lock = threading.Lock()
+_bytecode_cache_directory = None
+_template_hashes = {}
+
+
+def set_bytecode_cache(directory):
+    global _environment, _bytecode_cache_directory
+    with _environment_lock:
+        _bytecode_cache_directory = directory
+        _environment = None
+
+
+def get_environment():
+    global _environment
+    with _environment_lock:
+        if _environment is None:
+            bytecode_cache = None
+            if _bytecode_cache_directory:
+                os.makedirs(_bytecode_cache_directory, exist_ok=True)
+                bytecode_cache = jinja2.FileSystemBytecodeCache(_bytecode_cache_directory)
+                logger.debug(f"Template bytecode cache in {_bytecode_cache_directory}")
+            env = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(TEMPLATE_DIRECTORY),
+                bytecode_cache=bytecode_cache,
+                auto_reload=False,
+            )
+            env.filters["to_yaml"] = to_yaml
+            env.filters["to_json"] = to_json
+            env.filters["b64encode"] = b64encode
+            _environment = env
+        return _environment
+
+
+def get_template_hash(name):
+    # hash of the template source, part of the inputs of every manifest rendered from it
+    with _environment_lock:
+        if name in _template_hashes:
+            return _template_hashes[name]
+    environment = get_environment()
+    source, filename, uptodate = environment.loader.get_source(environment, f"{name}.yaml.j2")
+    template_hash = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    with _environment_lock:
+        _template_hashes[name] = template_hash
+    return template_hash
+
 
 class Template:
     def __init__(self, name):
         self.name = name
 
     def parse(self, **data):
-        env = jinja2.Environment()
-        env.filters["to_yaml"] = to_yaml
-        env.filters["to_json"] = to_json
-        env.filters["b64encode"] = b64encode
-        with open(f"./templates/{self.name}.yaml.j2") as f:
-            template = env.from_string(f.read())
-        parsed_template = template.render(data)
+        with measure("template", self.name) as event:
+            template = get_environment().get_template(f"{self.name}.yaml.j2")
+            parsed_template = template.render(data)
+            if event is not None:
+                event.size = len(parsed_template)
         return parsed_template
@@ -105,6 +105,37 @@ def print_resources(all_data):
     for field, line in all_data["totals"].items():
         print(f"{'': <10}{field: <10}{line['available']: >10}{line['used']: >10}{line['free']: >10}")
 
+def add_fleet_totals(fleet_totals, totals):
+    for field, line in totals.items():
+        if field not in fleet_totals:
+            fleet_totals[field] = {"available": 0, "used": 0, "free": 0}
+        for key in fleet_totals[field]:
+            fleet_totals[field][key] += line[key]
+    return fleet_totals
+
+def print_fleet_resources(all_data):
+    all_data = ordered_dict(all_data)
+    fleet_totals = {}
+
+    print(f"{'CLUSTER': <20}{'RESOURCE': <10}{'AVAILABLE': >10}{'USED': >10}{'FREE': >10}")
+    for name, data in all_data.items():
+        print(f"{name: <20}")
+        for field, line in data["totals"].items():
+            print(f"{'': <20}{field: <10}{line['available']: >10}{line['used']: >10}{line['free']: >10}")
+        fleet_totals = add_fleet_totals(fleet_totals, data["totals"])
+    print("FLEET TOTALS")
+    for field, line in fleet_totals.items():
+        print(f"{'': <20}{field: <10}{line['available']: >10}{line['used']: >10}{line['free']: >10}")
+
+def print_vm_summary(summary):
+    print(f"{'VM': <30}{'STATUS': <10}")
+    for name, status in summary.items():
+        print(f"{name: <30}{status: <10}")
+    counts = {}
+    for status in summary.values():
+        counts[status] = counts.get(status, 0) + 1
+    print(", ".join(f"{status}: {counts[status]}" for status in sorted(counts)))
+
 def get_value(data, key):
     if key in data:
         return data[key]
@@ -1,23 +1,58 @@
 #!/usr/bin/env python3
 
-from modules.utils import load_blueprint, load_config
-from modules.rancher import Rancher
+from modules.utils import load_blueprint, load_config, merge_dict
 from modules.harvester import Harvester
+from modules.templates import set_bytecode_cache
+from modules.state import State
+from modules import profiler
 
 import argparse
+import json
 import logging
+import os
+import sys
 
 logger = logging.getLogger(__name__)
 
 
-def provision(config, blueprint, args):
-    if not args.noupdatecluster:
-        if "cluster" in blueprint:
-            rancher = Rancher(config)
-            rancher.create_cluster(blueprint)
+def get_state(config, blueprint, args):
+    # one state per harvester cluster and blueprint
+    if "state_directory" not in config:
+        return None
+    cluster_name = merge_dict(config, blueprint)["harvester"]["cluster_name"]
+    name = os.path.splitext(os.path.basename(args.blueprint))[0]
+    return State(config["state_directory"], f"{cluster_name}-{name}")
+
 
-    harvester = Harvester(config, blueprint)
-    harvester.provision(args)
+def provision(config, blueprint, args):
+    with profiler.phase("harvester"):
+        harvester = Harvester(config, blueprint, state=get_state(config, blueprint, args))
+    # the cluster is created as a step of the provisioning graph, so rancher
+    # provisions it while networks, images and vm manifests are prepared
+    update_cluster = not args.noupdatecluster and "cluster" in blueprint
+    try:
+        harvester.provision(args, update_cluster)
+    finally:
+        harvester.close()
+
+
+def render(config, blueprint, args):
+    # a snapshot from an earlier run replaces the image and pci device lookups, so the
+    # cluster is not contacted at all; a missing snapshot is written after one lookup
+    snapshot = None
+    if args.snapshot and os.path.exists(args.snapshot):
+        with open(args.snapshot) as f:
+            snapshot = json.load(f)
+    with profiler.phase("harvester"):
+        harvester = Harvester(config, blueprint, snapshot=snapshot)
+    try:
+        if args.snapshot and snapshot is None:
+            with open(args.snapshot, "w") as f:
+                json.dump(harvester.get_snapshot(), f)
+            logger.info(f"Snapshot written to {args.snapshot}")
+        return harvester.render(args.render_only, args.parallel, config.get("template_cache"))
+    finally:
+        harvester.close()
 
 
 def set_logging(config, log_level, log_filename):
@@ -65,6 +100,34 @@ def main():
         help="VM names (comma seperated) in case updatevm is used, if empty all vms are updated",
         default="",
     )
+    parser.add_argument(
+        "--parallel",
+        help="number of provisioning steps run concurrently (default machines.parallelism or 1)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--plan",
+        help="show the provisioning steps and their dependencies without changing anything",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--render-only",
+        help="render the network, ip pool, cloud-init secret and vm manifests to this directory (- for one stream on stdout) without changing anything",
+        default=None,
+    )
+    parser.add_argument(
+        "--snapshot",
+        help="images and pci devices for --render-only, read from this file or saved to it when missing",
+        default="",
+    )
+    parser.add_argument(
+        "--profile",
+        help="time API calls and template rendering per phase, print a summary and write a chrome trace to this file",
+        nargs="?",
+        const="profile.json",
+        default=None,
+    )
     parser.add_argument("--loglevel", help="loglevel", default="")
     parser.add_argument("--logfile", help="logfile name", default="")
 
@@ -75,8 +138,21 @@ def main():
 
     set_logging(config, args.loglevel, args.logfile)
 
-    if blueprint is not None:
-        provision(config, blueprint, args)
+    if "template_cache" in config:
+        set_bytecode_cache(config["template_cache"])
+
+    if args.profile is not None:
+        profiler.enable()
+
+    try:
+        if blueprint is not None:
+            if args.render_only is not None:
+                if render(config, blueprint, args) is None:
+                    sys.exit(1)
+            else:
+                provision(config, blueprint, args)
+    finally:
+        profiler.report(args.profile)
 
 
 if __name__ == "__main__":
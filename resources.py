@@ -1,7 +1,19 @@
 #!/usr/bin/env python3
 
-from modules.utils import load_blueprint, load_config, print_resources
+from modules.utils import (
+    load_blueprint,
+    load_config,
+    print_resources,
+    print_fleet_resources,
+)
 from modules.harvester import Harvester
+from modules.rancher import Rancher
+from modules.kubernetes import Kubernetes
+from modules.inventory import Inventory, serve
+from modules.exporter import Exporter, ExporterRequestHandler
+from modules import profiler
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import argparse
 import logging
@@ -10,11 +22,70 @@ logger = logging.getLogger(__name__)
 
 
 def resources(config, blueprint):
-    harvester = Harvester(config, blueprint)
-    data = harvester.get_resources()
+    with profiler.phase("harvester"):
+        harvester = Harvester(config, blueprint)
+    try:
+        with profiler.phase("resources"):
+            data = harvester.get_resources()
+    finally:
+        harvester.close()
     print_resources(data)
 
 
+def fleet_resources(config, cluster_names, parallelism):
+    # one rancher session for all clusters, clusters are collected concurrently
+    rancher = Rancher(config)
+    if cluster_names == ["all"]:
+        cluster_names = rancher.get_harvester_clusters()
+
+    def get_resources(cluster_name):
+        with profiler.phase("resources", cluster_name):
+            harvester = Harvester(
+                config, {"harvester": {"cluster_name": cluster_name}}, rancher
+            )
+            try:
+                return harvester.get_resources()
+            finally:
+                harvester.close()
+
+    all_data = {}
+    with ThreadPoolExecutor(max_workers=max(parallelism, 1)) as executor:
+        futures = {
+            executor.submit(get_resources, cluster_name): cluster_name
+            for cluster_name in cluster_names
+        }
+        for future in as_completed(futures):
+            cluster_name = futures[future]
+            try:
+                all_data[cluster_name] = future.result()
+            except Exception as e:
+                logger.error(f"Failed to get resources of cluster {cluster_name}: {e}")
+    rancher.close()
+
+    for cluster_name in sorted(all_data):
+        print(f"CLUSTER {cluster_name}")
+        print_resources(all_data[cluster_name])
+        print()
+    print_fleet_resources(all_data)
+
+
+def inventory_daemon(config, blueprint, address, port, metrics_interval):
+    rancher = Rancher(config)
+    cluster_name = blueprint["harvester"]["cluster_name"]
+    kubernetes = Kubernetes(
+        rancher.get_kubeconfig(cluster_name),
+        unauthorized=lambda: rancher.invalidate_kubeconfig(cluster_name),
+    )
+    inventory = Inventory(config, kubernetes)
+    inventory.start()
+    exporter = Exporter(
+        inventory, blueprint["harvester"]["cluster_name"], metrics_interval
+    )
+    exporter.start()
+    serve(inventory, address, port, ExporterRequestHandler, exporter=exporter)
+    exporter.stop()
+
+
 def set_logging(config, log_level, log_filename):
     if log_level == "":
         if "logging" in config:
@@ -48,19 +119,66 @@ def main():
         add_help=True,
     )
 
-    parser.add_argument("clustername", help="name of the cluster")
+    parser.add_argument(
+        "clustername",
+        help="name of the cluster, several names or 'all' for every Harvester cluster in Rancher",
+        nargs="+",
+    )
+    parser.add_argument(
+        "--parallel",
+        help="number of clusters collected concurrently",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--serve",
+        help="run as daemon, serving the resources as json on this port",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--listen", help="address to listen on in daemon mode", default="127.0.0.1"
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        help="seconds between refreshes of the prometheus metrics in daemon mode",
+        type=int,
+        default=15,
+    )
+    parser.add_argument(
+        "--profile",
+        help="time API calls per phase, print a summary and write a chrome trace to this file",
+        nargs="?",
+        const="profile.json",
+        default=None,
+    )
     parser.add_argument("--loglevel", help="loglevel", default="")
     parser.add_argument("--logfile", help="logfile name", default="")
 
     args = parser.parse_args()
 
     config = load_config("./config")
-    blueprint = {"harvester": {"cluster_name": args.clustername }}
+    blueprint = {"harvester": {"cluster_name": args.clustername[0] }}
 
     set_logging(config, args.loglevel, args.logfile)
 
-    if blueprint is not None:
-        resources(config, blueprint)
+    if args.profile is not None:
+        profiler.enable()
+
+    try:
+        if args.serve is not None:
+            if len(args.clustername) > 1 or args.clustername == ["all"]:
+                logger.error("Daemon mode supports a single cluster")
+                return
+            inventory_daemon(
+                config, blueprint, args.listen, args.serve, args.metrics_interval
+            )
+        elif len(args.clustername) > 1 or args.clustername == ["all"]:
+            fleet_resources(config, args.clustername, args.parallel)
+        elif blueprint is not None:
+            resources(config, blueprint)
+    finally:
+        profiler.report(args.profile)
 
 
 if __name__ == "__main__":
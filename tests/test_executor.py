@@ -0,0 +1,99 @@
+import threading
+
+from modules.executor import StepGraph, StepError
+
+import pytest
+
+
+def fail():
+    raise StepError("failed")
+
+
+def test_failed_step_skips_only_its_dependents():
+    graph = StepGraph()
+    graph.add("a", lambda: "a")
+    graph.add("b", fail, requires=["a"])
+    graph.add("c", lambda: "c", requires=["b"])
+    graph.add("d", lambda: "d", requires=["c"])
+    graph.add("e", lambda: "e", requires=["a"])
+    graph.add("f", lambda: "f")
+    results = graph.run(workers=2)
+    assert results == {"a": "a", "e": "e", "f": "f"}
+    assert list(graph.errors) == ["b"]
+    assert graph.skipped == {"c", "d"}
+    assert not graph.succeeded("b")
+
+
+def test_step_with_a_failed_and_a_successful_requirement_is_skipped():
+    graph = StepGraph()
+    graph.add("ok", lambda: 1)
+    graph.add("broken", fail)
+    graph.add("both", lambda: 2, requires=["ok", "broken"])
+    graph.run(workers=1)
+    assert graph.skipped == {"both"}
+    assert graph.results == {"ok": 1}
+
+
+def test_background_step_does_not_use_a_worker():
+    # with a single worker the foreground step can only run while the
+    # background step waits if the background step has no worker slot
+    started = threading.Event()
+    graph = StepGraph()
+    graph.add("cluster", lambda: started.wait(timeout=5), background=True)
+    graph.add("network", started.set)
+    graph.run(workers=1)
+    assert graph.results["cluster"] is True
+
+
+def test_requirements_results_are_available_to_dependents():
+    graph = StepGraph()
+    graph.add("token", lambda: "secret")
+    graph.add("kubeconfig", lambda: graph.results["token"].upper(), requires=["token"])
+    graph.run(workers=4)
+    assert graph.results["kubeconfig"] == "SECRET"
+
+
+def test_add_rejects_unknown_requirements_and_duplicates():
+    graph = StepGraph()
+    graph.add("a", lambda: None, requires=[None])
+    with pytest.raises(ValueError):
+        graph.add("b", lambda: None, requires=["missing"])
+    with pytest.raises(ValueError):
+        graph.add("a", lambda: None)
+
+
+def test_stages_and_heights():
+    graph = StepGraph()
+    graph.add("a", lambda: None)
+    graph.add("b", lambda: None, requires=["a"])
+    graph.add("c", lambda: None, requires=["b"])
+    graph.add("d", lambda: None)
+    assert graph.get_stages() == {"a": 0, "b": 1, "c": 2, "d": 0}
+    assert graph.get_heights() == {"a": 3, "b": 2, "c": 1, "d": 1}
+
+
+def test_step_after_a_failed_or_skipped_step_still_runs():
+    graph = StepGraph()
+    graph.add("shared", lambda: "shared")
+    graph.add("prepare ok", lambda: "ok")
+    graph.add("prepare broken", fail)
+    graph.add("render broken", lambda: "never", requires=["prepare broken"])
+    graph.add(
+        "create",
+        lambda: sorted(graph.results),
+        requires=["shared"],
+        after=["prepare ok", "prepare broken", "render broken"],
+    )
+    graph.run(workers=2)
+    assert graph.skipped == {"render broken"}
+    assert graph.results["create"] == ["prepare ok", "shared"]
+
+
+def test_step_after_waits_for_its_predecessors():
+    order = []
+    graph = StepGraph()
+    graph.add("slow", lambda: order.append("slow") or threading.Event().wait(0.1))
+    graph.add("next", lambda: order.append("next"), after=["slow"])
+    graph.run(workers=4)
+    assert order == ["slow", "next"]
+    assert graph.get_stages() == {"slow": 0, "next": 1}
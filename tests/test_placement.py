@@ -0,0 +1,100 @@
+from modules.placement import Placement
+
+
+def get_node(cpu, memory, vm, pcidevices=(), vms=()):
+    return {
+        "resources": {
+            "cpu": {"available": cpu, "used": 0, "free": cpu},
+            "memory": {"available": memory, "used": 0, "free": memory},
+            "vm": {"available": vm, "used": 0, "free": vm},
+        },
+        "pcidevices": [
+            {"name": address, "address": address, "deviceName": "gpu", "usedBy": ""}
+            for address in pcidevices
+        ],
+        "vms": {name: {} for name in vms},
+    }
+
+
+def get_config():
+    return {
+        "machines": {
+            "pcidevices": {
+                "gpu_1": {"address": ["0000:65:00.0"]},
+                "gpu_2": {"address": ["0000:66:00.0"]},
+            }
+        }
+    }
+
+
+def get_vm(name, cpu=2, memory=4, **kwargs):
+    return dict(name=name, cpu=cpu, memory=memory, **kwargs)
+
+
+def test_vm_with_pcidevice_goes_to_the_node_with_that_address():
+    placement = Placement(
+        get_config(),
+        {
+            "nodes": {
+                "node-a": get_node(64, 256, 10),
+                "node-b": get_node(8, 32, 10, ["0000:65:00.0"]),
+            }
+        },
+    )
+    vm = get_vm("gpu", pcidevices=["gpu_1"])
+    assert placement.place([vm]) == []
+    assert vm["harvester_node"] == "node-b"
+
+
+def test_pcidevice_is_used_only_once():
+    placement = Placement(
+        get_config(),
+        {"nodes": {"node-b": get_node(64, 256, 10, ["0000:65:00.0"])}},
+    )
+    first = get_vm("gpu-1", pcidevices=["gpu_1"])
+    second = get_vm("gpu-2", pcidevices=["gpu_1"])
+    assert placement.place([first, second]) == ["gpu-2"]
+    assert first["harvester_node"] == "node-b"
+    assert "harvester_node" not in second
+
+
+def test_node_without_free_vm_slots_is_not_used():
+    placement = Placement(
+        get_config(),
+        {"nodes": {"node-a": get_node(64, 256, 0), "node-b": get_node(64, 256, 1)}},
+    )
+    first = get_vm("vm-1")
+    second = get_vm("vm-2")
+    assert placement.place([first, second]) == ["vm-2"]
+    assert first["harvester_node"] == "node-b"
+
+
+def test_best_fit_and_capacity():
+    placement = Placement(
+        get_config(),
+        {"nodes": {"small": get_node(4, 16, 10), "large": get_node(32, 128, 10)}},
+    )
+    fits_small = get_vm("fits-small", cpu=4, memory=16)
+    too_big = get_vm("too-big", cpu=64, memory=16)
+    assert placement.place([fits_small, too_big]) == ["too-big"]
+    assert fits_small["harvester_node"] == "small"
+
+
+def test_running_and_pinned_vms_keep_their_node_and_use_capacity():
+    placement = Placement(
+        get_config(),
+        {
+            "nodes": {
+                "node-a": get_node(8, 32, 10, vms=["running"]),
+                "node-b": get_node(8, 32, 10),
+            }
+        },
+    )
+    running = get_vm("running")
+    pinned = get_vm("pinned", cpu=8, memory=32, harvester_node="node-b")
+    new = get_vm("new", cpu=8, memory=32)
+    assert placement.place([running, pinned, new]) == []
+    assert running["harvester_node"] == "node-a"
+    assert pinned["harvester_node"] == "node-b"
+    # node-b is full with the pinned vm
+    assert new["harvester_node"] == "node-a"
@@ -0,0 +1,142 @@
+from collections import Counter
+from types import SimpleNamespace
+
+from modules.pcidevices import PciInventory
+from modules.resources import Resources, ResourceLedger, AVAILABLE, USED
+
+
+def get_node(name, cpu, memory, pods):
+    status = SimpleNamespace(
+        capacity={"cpu": str(cpu), "memory": f"{memory}Gi", "pods": str(pods)},
+        allocatable={"cpu": str(cpu), "memory": f"{memory}Gi", "pods": str(pods)},
+    )
+    return SimpleNamespace(metadata=SimpleNamespace(name=name), status=status)
+
+
+def get_instance(name, cpu, memory, host_devices=()):
+    devices = {}
+    if host_devices:
+        devices["hostDevices"] = [
+            {"name": device, "deviceName": device_name} for device, device_name in host_devices
+        ]
+    return {
+        "metadata": {"name": name},
+        "spec": {
+            "domain": {
+                "cpu": {"cores": cpu},
+                "memory": {"guest": f"{memory}Gi"},
+                "devices": devices,
+            }
+        },
+    }
+
+
+def get_pcidevice(node, name, address, resource_name):
+    return {
+        "metadata": {"name": name, "labels": {"nodename": node}},
+        "status": {"address": address, "resourceName": resource_name},
+    }
+
+
+def get_resources():
+    config = {"resource_definitions": {"gpu": ["nvidia.com/GPU"], "nvme": ["intel.com/NVME"]}}
+    pci_inventory = PciInventory(None)
+    pci_inventory.index(
+        {
+            "items": [
+                get_pcidevice("node-a", "node-a-gpu-0", "0000:65:00.0", "nvidia.com/GPU"),
+                get_pcidevice("node-a", "node-a-gpu-1", "0000:66:00.0", "nvidia.com/GPU"),
+                get_pcidevice("node-b", "node-b-nvme-0", "0000:17:00.0", "intel.com/NVME"),
+                get_pcidevice("node-b", "node-b-nic-0", "0000:18:00.0", "intel.com/NIC"),
+            ]
+        },
+        {
+            "items": [
+                {"metadata": {"name": "node-a-gpu-0"}, "spec": {"nodeName": "node-a"}},
+                {"metadata": {"name": "node-a-gpu-1"}, "spec": {"nodeName": "node-a"}},
+                {"metadata": {"name": "node-b-nvme-0"}, "spec": {"nodeName": "node-b"}},
+                {"metadata": {"name": "node-b-nic-0"}, "spec": {"nodeName": "node-b"}},
+            ]
+        },
+    )
+    return Resources(config, None, pci_inventory=pci_inventory)
+
+
+def get_report():
+    nodes = [get_node("node-a", 32, 128, 110), get_node("node-b", 16, 64, 50)]
+    nodes_data = {
+        "node-a": {
+            "instances": {
+                "items": [
+                    get_instance("vm-1", 8, 32, [("node-a-gpu-0", "nvidia.com/GPU")]),
+                    get_instance("vm-2", 4, 16),
+                ]
+            },
+            "pod_count": 12,
+        },
+        "node-b": {
+            "instances": {"items": [get_instance("vm-3", 2, 8, [("node-b-nvme-0", "intel.com/NVME")])]},
+            "pod_count": 5,
+        },
+    }
+    return get_resources().get(nodes=nodes, nodes_data=nodes_data)
+
+
+def add_totals(totals, resources):
+    # the dict arithmetic of the report before the ledger
+    for field, values in resources.items():
+        total = totals.setdefault(field, {"available": 0, "used": 0, "free": 0})
+        for key in total:
+            total[key] += values[key]
+    return totals
+
+
+def test_totals_match_the_sum_of_the_node_reports():
+    report = get_report()
+    totals = {}
+    for node in report["nodes"].values():
+        totals = add_totals(totals, node["resources"])
+    assert report["totals"] == totals
+
+
+def test_node_values():
+    report = get_report()
+    node_a = report["nodes"]["node-a"]["resources"]
+    assert node_a["cpu"] == {"available": 32, "used": 12, "free": 20}
+    assert node_a["memory"] == {"available": 128, "used": 48, "free": 80}
+    assert node_a["vm"] == {"available": 98, "used": 2, "free": 96}
+    assert node_a["gpu"] == {"available": 2, "used": 1, "free": 1}
+    assert node_a["nvme"] == {"available": 0, "used": 0, "free": 0}
+    node_b = report["nodes"]["node-b"]["resources"]
+    assert node_b["nvme"] == {"available": 1, "used": 1, "free": 0}
+    assert report["totals"]["cpu"] == {"available": 48, "used": 14, "free": 34}
+    assert report["totals"]["vm"] == {"available": 143, "used": 3, "free": 140}
+    # only devices of a configured resource class are reported
+    addresses = [device["address"] for device in report["nodes"]["node-b"]["pcidevices"]]
+    assert addresses == ["0000:17:00.0"]
+    assert report["nodes"]["node-a"]["pcidevices"][0]["usedBy"] == "vm-1"
+
+
+def test_group_by_node_takes_pod_counts():
+    instances = {"items": [get_instance("vm-1", 2, 8)]}
+    instances["items"][0]["metadata"]["labels"] = {"kubevirt.io/nodeName": "node-a"}
+    nodes_data = get_resources().group_by_node(instances, Counter({"node-a": 3, "node-b": 2}))
+    assert nodes_data["node-a"]["pod_count"] == 3
+    assert len(nodes_data["node-a"]["instances"]["items"]) == 1
+    assert nodes_data["node-b"] == {"instances": {"items": []}, "pod_count": 2}
+
+
+def test_ledger_rows_are_independent():
+    ledger = ResourceLedger(["cpu", "memory"])
+    first = ledger.add_node("node-a")
+    second = ledger.add_node("node-b")
+    ledger.add(first, AVAILABLE, {"cpu": 8, "memory": 32})
+    ledger.add(first, USED, {"cpu": 2})
+    ledger.add(second, AVAILABLE, {"cpu": 4})
+    ledger.add(second, AVAILABLE, {"cpu": 4, "memory": 16})
+    assert ledger.get_node(first)["cpu"] == {"available": 8, "used": 2, "free": 6}
+    assert ledger.get_node(second)["cpu"] == {"available": 8, "used": 0, "free": 8}
+    assert ledger.get_totals() == {
+        "cpu": {"available": 16, "used": 2, "free": 14},
+        "memory": {"available": 48, "used": 0, "free": 48},
+    }
@@ -0,0 +1,50 @@
+import json
+import os
+
+from modules.state import State, fingerprint
+
+
+def test_save_and_load_round_trip(tmp_path):
+    state = State(str(tmp_path), "harvester-cluster")
+    state.set("vm-1", {"vm_inputs": "a", "vm_hash": "b"})
+    state.set("vm-2", {"vm_inputs": "c", "vm_hash": "d"})
+    state.save()
+    assert os.stat(state.filename).st_mode & 0o777 == 0o600
+    assert not os.path.exists(f"{state.filename}.tmp")
+
+    loaded = State(str(tmp_path), "harvester-cluster")
+    assert loaded.get("vm-1") == {"vm_inputs": "a", "vm_hash": "b"}
+    assert loaded.get("vm-2") == {"vm_inputs": "c", "vm_hash": "d"}
+    assert loaded.get("vm-3") == {}
+
+
+def test_prune_forgets_vms_removed_from_the_blueprint(tmp_path):
+    state = State(str(tmp_path), "blueprint")
+    for name in ["vm-1", "vm-2", "vm-3"]:
+        state.set(name, {"vm_inputs": name})
+    state.prune({"vm-1", "vm-3", "vm-4"})
+    state.save()
+    assert set(State(str(tmp_path), "blueprint").vms) == {"vm-1", "vm-3"}
+
+
+def test_broken_state_is_ignored(tmp_path):
+    with open(tmp_path / "blueprint.json", "w") as f:
+        f.write("{not json")
+    assert State(str(tmp_path), "blueprint").vms == {}
+
+
+def test_states_are_separate_per_name(tmp_path):
+    first = State(str(tmp_path), "cluster-a-blueprint")
+    first.set("vm-1", {"vm_inputs": "a"})
+    first.save()
+    assert State(str(tmp_path), "cluster-b-blueprint").get("vm-1") == {}
+    with open(first.filename) as f:
+        assert json.load(f) == {"vms": {"vm-1": {"vm_inputs": "a"}}}
+
+
+def test_fingerprint_ignores_key_order_and_sees_changes():
+    vm = {"name": "vm-1", "cpu": 2, "memory": 8}
+    same = {"memory": 8, "cpu": 2, "name": "vm-1"}
+    assert fingerprint("config", vm) == fingerprint("config", same)
+    assert fingerprint("config", vm) != fingerprint("config", dict(vm, cpu=4))
+    assert fingerprint("config", vm) != fingerprint("other config", vm)